@@ -1,7 +1,65 @@
+import argparse
 import os
 import shutil
-import subprocess
-from datetime import date
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from string import Template
+
+import dashboard
+from classsubset import parse_selection, subset_class_averages
+from harvester import InimodelHarvester
+from inimodel_metrics import get_metric, run_model_file
+from instrumentation import EventLog, timed
+from jobcache import DigestCache, ResultIndex, inputs_hash
+from mapsimilarity import select_distinct
+from mrc import MrcFile
+from rescale import rescale_maps
+from resources import ResourceHistory, count_star_rows, query_usage
+from starparser import SPLIT_COLUMNS, SPLIT_MODES, Star
+from starpaths import redirect_image_paths
+
+# Submission file templates, rendered once per run
+MODULES = 'module purge' + '\n' + \
+          'shopt -s expand_aliases' + '\n' + \
+          'source /usr/users/rubsak/sw/rubsak.bashrc' + '\n' + \
+          'use_relion4' + '\n' + \
+          '# load relion/4.0.0' + '\n' + \
+          'echo - e "$(hostname) modules: $(module list 2>&1 | grep relion --color=never)"' + '\n'
+
+INIMODEL_SUBMISSION = Template('''#!/bin/bash -l
+#SBATCH -D $directory/
+#SBATCH -J inimodel
+#SBATCH -C scratch
+#SBATCH --partition=medium
+#SBATCH --error=$directory/inimodel_${co}co.err
+#SBATCH --output=$directory/inimodel_${co}co.out
+#SBATCH --ntasks=$cpus
+#SBATCH -t $time_request
+${memory}#SBATCH --qos=short
+$modules$staging$command''')
+
+REFINE_SUBMISSION = Template('''#!/bin/bash -l
+#SBATCH -D $directory/
+#SBATCH -J refine
+#SBATCH -C scratch
+#SBATCH --partition=gpu
+#SBATCH --error=$directory/refine_$label.err
+#SBATCH --output=$directory/refine_$label.out
+# Ressource settings
+#SBATCH --gres=gpu:$gpu
+#SBATCH --cpus-per-task=$cpu
+#SBATCH --nodes=$nodes
+#SBATCH --ntasks=$ntasks
+#SBATCH --mem-per-cpu=$memory_per_cpu
+#SBATCH -t $time_request
+$modules$command
+''')
+
+# Threads creating run folders and files
+FILE_WORKERS = 16
+# relion_refine_mpi --auto_refine: leader rank plus one rank per half set
+MIN_CPU_MPIS = 3
 
 
 class Project:
@@ -9,11 +67,16 @@ class Project:
     Represents the workflow based on a set of 2D class averages.
     '''
 
-    def __init__(self):
+    def __init__(self, project_folder='', job=''):
         '''
         - Initialize project folder
+        - project_folder / job: load a project and run a job without asking (used by scheduled pipeline jobs)
         '''
 
+        # Timing events, written to project/timing.jsonl once the project folder is known
+        self.events = EventLog()
+        load_start = time.perf_counter()
+
         # Initialize constants
         self.job = None
         self.inimodel_runs_master = None
@@ -22,6 +85,7 @@ class Project:
         self.refine_submission_file_paths = None
         self.inimodels_for_refine = None
         self.co_selection = None
+        self.class_averages = None
         self.inimodel_settings = [
             'inimodel_cpus',
             'inimodel_crossover_range_min',
@@ -33,6 +97,63 @@ class Project:
             'inimodel_angle',
             'inimodel_angle_step',
             'inimodel_sym',
+            'inimodel_max_res',
+            'inimodel_sweep_mode',
+            'inimodel_adaptive_metric',
+            'inimodel_adaptive_top',
+            'inimodel_adaptive_min_step',
+            'inimodel_adaptive_tolerance',
+            'inimodel_adaptive_max_rounds',
+            'inimodel_pack_size',
+            'inimodel_class_subset',
+            'inimodel_class_subset_compact'
+        ]
+        # relion_refine options set from refine settings. Switches are given if the setting is true.
+        self.refine_switches = [
+            ('refine_auto_refine', '--auto_refine'),
+            ('refine_split_random_halves', '--split_random_halves'),
+            ('refine_dont_combine_weights_via_disc', '--dont_combine_weights_via_disc'),
+            ('refine_skip_gridding', '--skip_gridding'),
+            ('refine_ctf', '--ctf'),
+            ('refine_flatten_solvent', '--flatten_solvent'),
+            ('refine_zero_mask', '--zero_mask'),
+            ('refine_norm', '--norm'),
+            ('refine_scale', '--scale'),
+            ('refine_helix', '--helix'),
+            ('refine_helical_keep_tilt_prior_fixed', '--helical_keep_tilt_prior_fixed')
+        ]
+        self.refine_options = [
+            ('refine_ini_high', '--ini_high'),
+            ('refine_pad', '--pad'),
+            ('refine_particle_diameter', '--particle_diameter'),
+            ('refine_oversampling', '--oversampling'),
+            ('refine_healpix_order', '--healpix_order'),
+            ('refine_auto_local_healpix_order', '--auto_local_healpix_order'),
+            ('refine_offset_range', '--offset_range'),
+            ('refine_offset_step', '--offset_step'),
+            ('refine_sym', '--sym'),
+            ('refine_low_resol_join_halves', '--low_resol_join_halves'),
+            ('refine_taufudge', '--tau2_fudge')
+        ]
+        # Helical options, only used together with --helix
+        self.refine_helical_options = [
+            ('refine_helical_outer_diameter', '--helical_outer_diameter'),
+            ('refine_helical_nr_asu', '--helical_nr_asu'),
+            ('refine_helical_rise_initial', '--helical_rise_initial'),
+            ('refine_helical_z_percentage', '--helical_z_percentage'),
+            ('refine_sigma_tilt', '--sigma_tilt'),
+            ('refine_sigma_psi', '--sigma_psi'),
+            ('refine_sigma_rot', '--sigma_rot')
+        ]
+        # Settings that change the result of an inimodel run (used for its input hash)
+        self.inimodel_hash_settings = [
+            'general_px_size',
+            'inimodel_iter',
+            'inimodel_mask',
+            'inimodel_shift',
+            'inimodel_angle',
+            'inimodel_angle_step',
+            'inimodel_sym',
             'inimodel_max_res'
         ]
         self.refine_settings = [
@@ -73,14 +194,25 @@ class Project:
             'refine_cpu',
             'refine_nodes',
             'refine_mem_cpu',
-            'refine_taufudge'
+            'refine_taufudge',
+            'refine_pipeline_top',
+            'refine_similarity_threshold',
+            'refine_subset_mode',
+            'refine_subset_count',
+            'refine_subset_select',
+            'refine_px_size',
+            'refine_box_size'
         ]
 
         # Initialize project folder
         self.workdir = os.getcwd()
         self.date = self.set_date()
         project_folders = self.find_project_folders()
-        if len(project_folders) > 0:
+        if project_folder != '':
+            # Load given project
+            self.project_folder = os.path.basename(os.path.normpath(project_folder))
+            self.name = self.project_folder.split('_')[1]
+        elif len(project_folders) > 0:
             # List project folders, ask user which one to load
             print("Found the following project folders: ")
             for i in range(1, len(project_folders) + 1):
@@ -120,6 +252,7 @@ class Project:
             print('Created 3drefine folder ' + self.refine_folder)
         else:
             print('Project folder ' + self.project_folder + ' already exists. Skipping folder creation.')
+        self.events.set_path(os.path.join(self.settings_folder, 'timing.jsonl'))
 
         # Check user settings
         self.settings = dict(
@@ -139,45 +272,85 @@ class Project:
             inimodel_sym=2,
             inimodel_max_res=5,
             inimodel_cpus=24,
-            # 3DR settings
+            # Sweep mode: 'full' submits the whole crossover range, 'adaptive' goes coarse to fine
+            inimodel_sweep_mode='full',
+            inimodel_adaptive_metric='log_score',
+            inimodel_adaptive_top=3,
+            inimodel_adaptive_min_step=10,
+            inimodel_adaptive_tolerance=0.01,
+            inimodel_adaptive_max_rounds=4,
+            # Crossovers run side by side in one allocation: 1 = one job per crossover,
+            # N = N crossovers per job, 'node' = as many as fit into general_node_cpus
+            inimodel_pack_size=1,
+            # Class averages used for inimodel runs: 'all' or image numbers, e.g. '1 4 7-9'
+            inimodel_class_subset='all',
+            # Write the chosen class averages into a compact stack instead of referencing the full stack
+            inimodel_class_subset_compact=False,
+            general_node_cpus=96,
+            # Seconds between two scheduler queries while waiting for jobs
+            general_poll_interval=60,
+            # Set time, cpu and memory requests from the resource history of finished jobs
+            general_autotune_resources=False,
+            # Link results of identical earlier inimodel runs instead of recomputing them
+            general_reuse_results=True,
+            general_software_version='relion-4.0.0',
+            # Copy class averages to node-local scratch before inimodel runs read them
+            general_stage_inputs=False,
+            general_scratch_dir='$TMPDIR',
+            # 3DR settings (defaults of the helical reference refinement)
+            # 'auto': reference = selected initial model, twist = -calc_twist(crossover) (left-handed),
+            # mpis = nodes * gpus + 1, pool derived from the threads per rank
             refine_auto_refine=True,
             refine_split_random_halves=True,
             refine_particles='',
-            refine_reference='',
-            refine_ini_high='',
+            refine_reference='auto',
+            refine_ini_high=10,
             refine_dont_combine_weights_via_disc=True,
-            refine_pool=30,
-            refine_pad='',
-            refine_skip_gridding='',
-            refine_ctf='',
+            refine_pool='auto',
+            refine_pad=2,
+            refine_skip_gridding=True,
+            refine_ctf=True,
             refine_particle_diameter='',
-            refine_flatten_solvent='',
-            refine_zero_mask='',
-            refine_oversampling='',
-            refine_healpix_order='',
-            refine_auto_local_healpix_order='',
-            refine_offset_range='',
-            refine_offset_step='',
-            refine_sym='',
-            refine_low_resol_join_halves='',
-            refine_norm='',
-            refine_scale='',
-            refine_helix='',
+            refine_flatten_solvent=True,
+            refine_zero_mask=True,
+            refine_oversampling=1,
+            refine_healpix_order=3,
+            refine_auto_local_healpix_order=4,
+            refine_offset_range=5,
+            refine_offset_step=2,
+            refine_sym='C1',
+            refine_low_resol_join_halves=40,
+            refine_norm=True,
+            refine_scale=True,
+            refine_helix=True,
             refine_helical_outer_diameter='',
-            refine_helical_nr_asu='',
-            refine_helical_twist_initial='',
-            refine_helical_rise_initial='',
-            refine_helical_z_percentage='',
-            refine_sigma_tilt='',
-            refine_sigma_psi='',
-            refine_sigma_rot='',
-            refine_helical_keep_tilt_prior_fixed='',
-            refine_mpis='',
-            refine_gpu='',
-            refine_cpu='',
-            refine_nodes='',
+            refine_helical_nr_asu=3,
+            refine_helical_twist_initial='auto',
+            refine_helical_rise_initial=4.75,
+            refine_helical_z_percentage=0.17,
+            refine_sigma_tilt=5,
+            refine_sigma_psi=3.33333,
+            refine_sigma_rot=0,
+            refine_helical_keep_tilt_prior_fixed=True,
+            refine_mpis='auto',
+            refine_gpu=4,
+            refine_cpu=8,
+            refine_nodes=1,
             refine_mem_cpu=8000,
-            refine_taufudge=''
+            refine_taufudge=1,
+            # Number of best crossovers refined automatically in pipeline mode
+            refine_pipeline_top=3,
+            # Initial models correlating above this value count as one model (0 = compare no models)
+            refine_similarity_threshold=0.95,
+            # Quick refinements on particle subsets: 'none', 'class', 'tube', 'random' or 'stratified'
+            # count: number of subsets (tube, random, stratified), select: subsets to refine ('all' or e.g. '1 3-4')
+            refine_subset_mode='none',
+            refine_subset_count=4,
+            refine_subset_select='all',
+            # Pixel size and box the selected initial models are rescaled to before refinement
+            # 'auto': from the optics block of refine_particles, 'none': use the initial models as they are
+            refine_px_size='auto',
+            refine_box_size='auto'
         )
 
         # Check if user settings are present, if yes load them, if not write them
@@ -199,8 +372,15 @@ class Project:
                     print('Pixel size must be a float!')
             self.settings["general_ca_location"] = input('Class average star file: ')
             self.settings["general_ca_mrc_location"] = self.settings["general_ca_location"][:-4] + 'mrcs'
-            self.manipulate_ca_starfile()
-            self.create_link_to_ca_starfile()
+            redirect = input('Write a redirected copy into the project instead of modifying ' +
+                             'the class average star file? [y/n]: ')
+            if redirect.strip().lower().startswith('y'):
+                redirected_copy = os.path.join(self.classes_folder, 'class_averages.star')
+                self.manipulate_ca_starfile(output=redirected_copy)
+                self.settings["general_ca_location"] = redirected_copy
+            else:
+                self.manipulate_ca_starfile()
+                self.create_link_to_ca_starfile()
             self.write_settings()
 
         # Check if job counters are present, if yes load them, if not write them
@@ -230,14 +410,34 @@ class Project:
         else:
             self.write_archive()
 
+        # Collect resource usage of finished jobs
+        self.resource_history_path = os.path.join(self.settings_folder, 'resource_history.txt')
+        self.resource_history = ResourceHistory(self.resource_history_path)
+        self.resource_keys_cache = dict()
+        self.collect_resource_usage()
+
+        # Input digests of this project, result index shared by all projects of the working directory
+        self.digest_cache = DigestCache(os.path.join(self.settings_folder, 'input_digests.txt'))
+        self.result_index = ResultIndex(os.path.join(self.workdir, 'inimodel_result_index.txt'))
+        # Rescaled initial models, shared by all refinements of the project
+        self.rescale_cache = os.path.join(self.settings_folder, 'rescale_cache')
+        self.rescaled_references = dict()
+        self.events.emit('stage', stage='project_load', duration_s=round(time.perf_counter() - load_start, 6),
+                         project=self.project_folder, created=not self.is_exist)
+
         # Check what to run
-        self.get_job()
+        if job == '':
+            self.get_job()
+        else:
+            self.job = job
 
         # Run what to run
         if self.job == "inimodel":
             self.inimodel()
         elif self.job == "refine":
             self.refine()
+        elif self.job == "pipeline":
+            self.pipeline()
 
     ## Functions
 
@@ -254,6 +454,7 @@ class Project:
         date_string = today.strftime("%y%m%d")
         return date_string
 
+    @timed()
     def write_settings(self):
         # Writes settings found in dictionary into file
         sorted_dict = {key: value for key, value in sorted(self.settings.items())}
@@ -263,6 +464,7 @@ class Project:
         with open(self.settings_path, 'w') as fout:
             fout.write(output)
 
+    @timed()
     def read_settings(self, settingsfile):
         # Reads settings found in the user_settings.txt
         with open(settingsfile) as fin:
@@ -290,50 +492,46 @@ class Project:
 
     def get_job(self):
         while True:
-            print('What job do you want to run?' + '\n' + '1. Initial model generation' + '\n' + '2. Refinement')
+            print('What job do you want to run?' + '\n' + '1. Initial model generation' + '\n' + '2. Refinement' +
+                  '\n' + '3. Initial model generation + refinement of the best crossovers (pipeline)')
             try:
-                contract = int(input('[1, 2]: '))
+                contract = int(input('[1, 2, 3]: '))
                 if contract == 1:
                     self.job = "inimodel"
                     break
                 elif contract == 2:
                     self.job = "refine"
                     break
+                elif contract == 3:
+                    self.job = "pipeline"
+                    break
                 else:
                     raise ()
 
             except:
-                print('Please specify with "1" or "2"!')
+                print('Please specify with "1", "2" or "3"!')
 
     def write_file(self, string, file):
         with open(file, 'w') as fout:
             fout.write(string)
 
-    def manipulate_ca_starfile(self):
+    @timed()
+    def manipulate_ca_starfile(self, output=None):
         # Have to do this, since relion programs all need to be run from toplevel folder :l
-        # Create copy of original .star file
+        # Redirects the image paths of the class average .star file to general_ca_mrc_location
+        # output: write a redirected copy there instead of modifying the original file
         src = self.settings['general_ca_location']
-        dst = self.settings['general_ca_location'] + '_orig'
-        print('Creating copy of ' + src + 'as ' + dst)
-        shutil.copy2(src, dst)
-        # Manipulate original .star file
-        print('Manipulating original file so that general dir location usage is possible.')
-        with open(self.settings['general_ca_location']) as fin:
-            print(self.settings['general_ca_location'])
-            lines = fin.readlines()
-            lines_out = []
-            for line in lines:
-                if '@' in line:
-                    to_replace = line.strip().split()[0].split('@')[1]
-                    lines_out.append(line.replace(to_replace, self.settings['general_ca_mrc_location']))
-                else:
-                    lines_out.append(line)
-            with open(self.settings['general_ca_location'], 'w') as fout:
-                output = ''
-                for line in lines_out:
-                    output += line
-                print(output)
-                fout.write(output)
+        if output is None:
+            # Create copy of original .star file
+            output = src
+            dst = src + '_orig'
+            print('Creating copy of ' + src + ' as ' + dst)
+            shutil.copy2(src, dst)
+        # Streamed rewrite, output is only replaced once it is complete
+        print('Redirecting image paths of ' + src + ' to ' + self.settings['general_ca_mrc_location'] +
+              ' (writing ' + output + ').')
+        rewritten = redirect_image_paths(src, output, self.settings['general_ca_mrc_location'])
+        print('Rewrote ' + str(rewritten) + ' image paths.')
 
     def create_link_to_ca_starfile(self):
         # Create link to class average star file this project is based on
@@ -343,6 +541,7 @@ class Project:
         print('Creating link to class average file ' + src + ' as ' + dst)
         os.symlink(src, dst)
 
+    @timed()
     def read_archive(self):
         with open(self.archive_path) as fin:
             lines = fin.readlines()
@@ -352,10 +551,12 @@ class Project:
                     inimodel_job = Job(label, location, settings, log, status)
                     self.archive['inimodel_jobs'].append(inimodel_job)
                 elif jobtype == 'REFINE':
-                    return
+                    refine_job = Job(label, location, settings, log, status)
+                    self.archive['refine_jobs'].append(refine_job)
         print('Loaded the following archive.')
         print(self.archive)
 
+    @timed()
     def write_archive(self):
         output = ''
         with open(self.archive_path, 'w') as fout:
@@ -375,10 +576,166 @@ class Project:
         else:
             print('Please speficy which jobs to list.')
 
+    @timed()
+    def submit_jobs(self, files, dependency=''):
+        # Submits submission files to the hpc, returns the scheduler job ids
+        # dependency: slurm dependency string, e.g. 'afterok:123:124'
+        job_ids = []
+        for file in files:
+            print("Submitting " + file + " to hpc.")
+            cmd_string = 'sbatch --parsable '
+            if dependency != '':
+                cmd_string += '--dependency=' + dependency + ' '
+            cmd_string += file
+            result = self.events.run(cmd_string, text=True, check=True, capture_output=True)
+            # --parsable prints "jobid" or "jobid;cluster"
+            job_ids.append(result.stdout.strip().split(';')[0])
+        return job_ids
+
+    def record_job_ids(self, location, files, job_ids):
+        # Appends submitted jobs to the job id list of a job folder
+        with open(os.path.join(location, 'job_ids.txt'), 'a') as fout:
+            for i in range(len(files)):
+                fout.write(files[i] + ',' + job_ids[i] + '\n')
+
+    @timed()
+    def wait_for_jobs(self, job_ids, max_errors=10):
+        # Polls the scheduler until none of the given jobs is pending or running anymore
+        # Failed squeue calls (e.g. slurmctld timeouts) are retried, up to max_errors in a row
+        if len(job_ids) == 0:
+            return
+        cmd_string = 'squeue -h -o %i -j ' + ','.join(job_ids)
+        print('Waiting for ' + str(len(job_ids)) + ' jobs to finish.')
+        errors = 0
+        while True:
+            result = self.events.run(cmd_string, text=True, capture_output=True)
+            if result.returncode == 0:
+                errors = 0
+                if result.stdout.strip() == '':
+                    break
+            elif 'Invalid job id' in result.stderr:
+                # squeue rejects the request once none of the job ids is known anymore
+                break
+            else:
+                errors += 1
+                if errors >= max_errors:
+                    raise RuntimeError('squeue failed ' + str(errors) + ' times in a row: ' + result.stderr.strip())
+                print('squeue failed (' + result.stderr.strip() + '), retrying.')
+            time.sleep(float(self.settings['general_poll_interval']))
+
     def calc_twist(self, crossover):
         return 4.75 * 180 / crossover
 
+    # Resource functions
+    @timed()
+    def collect_resource_usage(self):
+        # Stores elapsed time, max RSS and CPU efficiency of all finished, not yet collected jobs
+        known_ids = self.resource_history.known_ids()
+        jobs = dict()
+        job_info = dict()
+        for jobtype in ['inimodel', 'refine']:
+            for job in self.archive[jobtype + '_jobs']:
+                ids_file = os.path.join(job.location, 'job_ids.txt')
+                if not os.path.exists(ids_file):
+                    continue
+                with open(ids_file) as fin:
+                    for line in fin:
+                        file, job_id = line.strip().split(',')
+                        # Selection jobs of pipelines are no refinements, pack jobs use the resources of
+                        # several runs and would be taken for a single run
+                        if job_id in known_ids or file.endswith('_select_submission.sh') or \
+                                self.is_pack_submission(file):
+                            continue
+                        jobs[job_id] = os.path.dirname(file)
+                        job_info[job_id] = (jobtype, job)
+        if len(jobs) == 0:
+            return
+        records = []
+        for job_id, entry in query_usage(jobs, run=self.events.run).items():
+            if entry['state'] in ('', 'PENDING', 'RUNNING', 'REQUEUED', 'SUSPENDED'):
+                continue
+            jobtype, job = job_info[job_id]
+            record = self.resource_keys(jobtype, self.parse_settings_file(job.settings_file), jobs[job_id])
+            record.update(
+                jobtype=jobtype,
+                label=job.label,
+                job_id=job_id,
+                cpus=entry['cpus'],
+                elapsed_s=round(entry['elapsed_s'], 1),
+                max_rss_mb=round(entry['max_rss_mb'], 1),
+                cpu_efficiency=round(entry['cpu_efficiency'], 3),
+                state=entry['state']
+            )
+            records.append(record)
+        self.resource_history.add(records)
+        if len(records) > 0:
+            print('Collected resource usage of ' + str(len(records)) + ' finished jobs.')
+
+    def parse_settings_file(self, settingsfile):
+        # Reads a settings file into a new dictionary (self.settings stays untouched)
+        settings = dict()
+        if not os.path.exists(settingsfile):
+            return settings
+        with open(settingsfile) as fin:
+            for line in fin:
+                if '=' in line:
+                    settings[line.split('=')[0].strip()] = line.split('=')[1].strip()
+        return settings
+
+    def resource_keys(self, jobtype, settings, directory):
+        # Box size, crossover, iterations and particle count a job's resource usage depends on
+        crossover = 0
+        run_folder = os.path.basename(os.path.normpath(directory))
+        if run_folder.endswith('co') and run_folder[:-2].isdigit():
+            crossover = int(run_folder[:-2])
+        elif run_folder.endswith('co_refine') and run_folder[:-9].isdigit():
+            crossover = int(run_folder[:-9])
+        box, class_averages = self.resource_keys_cache.get('ca_stack', (0, 0))
+        if 'ca_stack' not in self.resource_keys_cache and os.path.exists(self.settings['general_ca_mrc_location']):
+            stack = MrcFile(self.settings['general_ca_mrc_location'])
+            box, class_averages = stack.nx, stack.nz
+            self.resource_keys_cache['ca_stack'] = (box, class_averages)
+        if jobtype == 'inimodel':
+            iterations = int(settings.get('inimodel_iter', 0) or 0)
+            particles = class_averages
+        else:
+            # Auto-refine iterates until convergence
+            iterations = 0
+            particles = 0
+            particle_file = settings.get('refine_particles', '')
+            if particle_file in self.resource_keys_cache:
+                particles = self.resource_keys_cache[particle_file]
+            elif particle_file != '' and os.path.exists(particle_file):
+                particles = count_star_rows(particle_file)
+                self.resource_keys_cache[particle_file] = particles
+        return dict(box=box, crossover=crossover, iterations=iterations, particles=particles)
+
+    def suggest_resources(self, jobtype, crossover):
+        # Resource suggestion for a new job with the current settings, None without history
+        if jobtype == 'inimodel':
+            directory = str(crossover) + 'co'
+        else:
+            directory = str(crossover) + 'co_refine'
+        keys = self.resource_keys(jobtype, self.settings, directory)
+        return self.resource_history.suggest(jobtype, keys['box'], keys['crossover'], keys['iterations'],
+                                             keys['particles'])
+
+    def report_resource_suggestion(self, jobtype, crossover):
+        # Prints the suggested requests if autotuning is switched off
+        if self.setting_is_true('general_autotune_resources'):
+            print('Resource requests of ' + jobtype + ' jobs are set from the resource history.')
+            return
+        suggestion = self.suggest_resources(jobtype, crossover)
+        if suggestion is not None:
+            print('Suggested resources for ' + jobtype + ' jobs (from ' + self.resource_history_path + '): ' +
+                  'time ' + suggestion['time'] + ', cpus ' + str(suggestion['cpus']) + ', memory ' +
+                  str(suggestion['mem_mb']) + ' MB. Set general_autotune_resources = True to use them.')
+
+    def setting_is_true(self, setting):
+        return str(self.settings[setting]).strip().lower() in ('true', 'yes', '1')
+
     # Initial model functions
+    @timed()
     def inimodel(self):
         '''
         # Initiate and submit inimodel generation
@@ -402,22 +759,190 @@ class Project:
         #   - Write into project file, archive settings / results
         #   - Wait for results to finish, notify once done
 
+        # Adaptive sweeps submit, score and resubmit on their own
+        if self.settings['inimodel_sweep_mode'] == 'adaptive':
+            self.inimodel_adaptive()
+            return
+
         # For each step in ini model range, create a folder, then create submission file
+        self.create_inimodel_runs(self.get_crossover_range())
+
+        # Submit submission files to hpc
+        self.inimodel_submit()
+        # self.save_inimodel()
+
+    def get_crossover_range(self, step=None):
+        # Crossovers from range min to range max (inclusive), default step taken from the settings
+        if step is None:
+            step = int(self.settings['inimodel_crossover_step'])
+        return list(range(int(self.settings['inimodel_crossover_range_min']),
+                          int(self.settings['inimodel_crossover_range_max']) + step,
+                          step))
+
+    @timed()
+    def create_inimodel_runs(self, crossovers):
+        # For each crossover, create a run folder and write its submission file
+        # Finished runs with identical inputs are linked instead and not submitted again
+        # Scripts are rendered here, folders and files are created in one batch
         self.inimodel_submission_file_paths = []
-        for i in range(int(self.settings['inimodel_crossover_range_min']),
-                       int(self.settings['inimodel_crossover_range_max']) +
-                       int(self.settings['inimodel_crossover_step']),
-                       int(self.settings['inimodel_crossover_step'])):
+        reuse = self.setting_is_true('general_reuse_results')
+        runs = []
+        commands = []
+        new_hashes = []
+        for i in crossovers:
             inimodel_run_name = str(i) + 'co'
             inimodel_run_folder = os.path.join(self.inimodel_runs_master, inimodel_run_name)
-            os.mkdir(inimodel_run_folder)
-            submission_file = self.write_inimodel_submission(directory=inimodel_run_folder, crossover=i)
+            job_hash = self.inimodel_hash(i)
+            if reuse:
+                earlier_run = self.result_index.lookup(
+                    job_hash, lambda folder: os.path.exists(run_model_file(folder, i)))
+                if earlier_run is not None:
+                    print('Reusing results of ' + earlier_run + ' for ' + inimodel_run_name)
+                    os.symlink(earlier_run, inimodel_run_folder)
+                    continue
+            submission_file, submission, command = self.render_inimodel_submission(inimodel_run_folder, i)
+            runs.append((inimodel_run_folder, [(submission_file, submission),
+                                               (os.path.join(inimodel_run_folder, 'input_hash.txt'),
+                                                job_hash + '\n')]))
+            commands.append((inimodel_run_name, command))
+            new_hashes.append((job_hash, inimodel_run_folder))
             self.inimodel_submission_file_paths.append(submission_file)
+        self.create_run_files(runs)
+        self.journal_commands(self.inimodel_runs_master, commands)
+        self.result_index.add_many(new_hashes)
+        # Packed runs are submitted through pack scripts instead of one job per crossover
+        pack_size = self.get_pack_size()
+        if pack_size > 1 and len(self.inimodel_submission_file_paths) > 0:
+            run_files = self.inimodel_submission_file_paths
+            self.inimodel_submission_file_paths = []
+            for first in range(0, len(run_files), pack_size):
+                pack_file = self.write_inimodel_pack_submission(run_files[first:first + pack_size])
+                self.inimodel_submission_file_paths.append(pack_file)
+        return self.inimodel_submission_file_paths
+
+    def is_pack_submission(self, file):
+        # Submission files written by write_inimodel_pack_submission
+        name = os.path.basename(file)
+        return '_pack_' in name and name.endswith('co_submission.sh')
+
+    def get_pack_size(self):
+        # Number of crossovers per allocation
+        pack_size = str(self.settings['inimodel_pack_size']).strip()
+        if pack_size == 'node':
+            return max(1, int(self.settings['general_node_cpus']) // int(self.settings['inimodel_cpus']))
+        return max(1, int(pack_size))
+
+    @timed()
+    def write_inimodel_pack_submission(self, run_files):
+        '''
+        Submission file running several crossovers side by side in one allocation.
+        Every crossover runs its own submission file (the #SBATCH lines are comments for bash) in its run folder,
+        as an exclusive srun step if srun is available, else as a plain background process.
+        '''
+        crossovers = [os.path.basename(os.path.dirname(file))[:-2] for file in run_files]
+        label = 'pack_' + crossovers[0] + '_to_' + crossovers[-1] + 'co'
+        time_request, cpus, memory = self.inimodel_resources(int(crossovers[0]))
+        submissionstring = '#!/bin/bash -l' + '\n'
+        submissionstring += '#SBATCH -D ' + self.inimodel_runs_master + '/\n'
+        submissionstring += '#SBATCH -J inimodel_pack' + '\n'
+        submissionstring += '#SBATCH -C scratch' + '\n'
+        submissionstring += '#SBATCH --partition=medium' + '\n'
+        submissionstring += '#SBATCH --error=' + self.inimodel_runs_master + '/' + label + '.err' + '\n'
+        submissionstring += '#SBATCH --output=' + self.inimodel_runs_master + '/' + label + '.out' + '\n'
+        submissionstring += '#SBATCH --nodes=1' + '\n'
+        submissionstring += '#SBATCH --ntasks=' + str(len(run_files)) + '\n'
+        submissionstring += '#SBATCH --cpus-per-task=' + str(cpus) + '\n'
+        submissionstring += '#SBATCH -t ' + time_request + '\n'
+        if memory is not None:
+            submissionstring += '#SBATCH --mem=' + str(memory * len(run_files)) + 'M' + '\n'
+        submissionstring += '#SBATCH --qos=short' + '\n'
+        submissionstring += 'if command -v srun > /dev/null; then' + '\n'
+        submissionstring += '    LAUNCH="srun --exclusive --nodes=1 --ntasks=1 --cpus-per-task=' + str(cpus) + '"' + '\n'
+        submissionstring += 'else' + '\n'
+        submissionstring += '    LAUNCH=""' + '\n'
+        submissionstring += 'fi' + '\n'
+        for i in range(len(run_files)):
+            directory = os.path.dirname(run_files[i])
+            co = crossovers[i]
+            submissionstring += '(cd ' + directory + ' && $LAUNCH bash ' + run_files[i] + \
+                                ' > inimodel_' + co + 'co.out 2> inimodel_' + co + 'co.err) &' + '\n'
+        submissionstring += 'wait' + '\n'
+        submission_file_path = os.path.join(self.inimodel_runs_master, self.date + '_' + label + '_submission.sh')
+        self.write_file(submissionstring, submission_file_path)
+        return submission_file_path
 
-        # Submit submission files to hpc
-        self.inimodel_submit()
-        # self.save_inimodel()
+    def inimodel_hash(self, crossover):
+        # Hash of class average files, run parameters and software version of one inimodel run
+        star, stack = self.get_class_averages()
+        file_digests = [self.digest_cache.digest(star), self.digest_cache.digest(stack)]
+        parameters = dict(crossover=crossover)
+        for setting in self.inimodel_hash_settings:
+            parameters[setting] = self.settings[setting]
+        return inputs_hash(file_digests, parameters, str(self.settings['general_software_version']))
+
+    @timed()
+    def inimodel_adaptive(self):
+        '''
+        Coarse-to-fine crossover sweep.
+        - Submit the coarse grid (range min to max with inimodel_crossover_step)
+        - Wait for the jobs, score every finished run with inimodel_adaptive_metric
+        - Halve the step and submit the neighbours of the best inimodel_adaptive_top crossovers
+        - Stop once the best score improves by less than inimodel_adaptive_tolerance (relative),
+          the step reaches inimodel_adaptive_min_step or inimodel_adaptive_max_rounds rounds are done
+        '''
+        metric = get_metric(self.settings['inimodel_adaptive_metric'])
+        co_min = int(self.settings['inimodel_crossover_range_min'])
+        co_max = int(self.settings['inimodel_crossover_range_max'])
+        step = int(self.settings['inimodel_crossover_step'])
+        top = int(self.settings['inimodel_adaptive_top'])
+        min_step = int(self.settings['inimodel_adaptive_min_step'])
+        tolerance = float(self.settings['inimodel_adaptive_tolerance'])
+        max_rounds = int(self.settings['inimodel_adaptive_max_rounds'])
+
+        scores = dict()
+        best_score = None
+        candidates = self.get_crossover_range(step)
+        sweep_round = 0
+        while len(candidates) > 0:
+            sweep_round += 1
+            print('Adaptive sweep round ' + str(sweep_round) + ' (step ' + str(step) + '): ' +
+                  ' '.join([str(co) for co in candidates]))
+            self.create_inimodel_runs(candidates)
+            job_ids = self.inimodel_submit()
+            self.wait_for_jobs(job_ids)
+            # Score finished runs
+            for co in candidates:
+                run_folder = os.path.join(self.inimodel_runs_master, str(co) + 'co')
+                scores[co] = metric(run_folder, co)
+            self.write_sweep_scores(scores)
+            ranked = sorted([co for co in scores if scores[co] is not None], key=scores.get, reverse=True)
+            if len(ranked) == 0:
+                print('No run of this round produced a score. Stopping adaptive sweep.')
+                break
+            round_best = scores[ranked[0]]
+            print('Best crossover so far: ' + str(ranked[0]) + 'co (score ' + str(round_best) + ')')
+            # Stop if improvement stalls
+            if best_score is not None and round_best - best_score <= tolerance * abs(best_score):
+                print('Improvement below tolerance. Stopping adaptive sweep.')
+                break
+            best_score = round_best
+            if step <= min_step or sweep_round >= max_rounds:
+                break
+            # Refine around the best candidates
+            step = max(step // 2, min_step)
+            candidates = sorted(set([c for co in ranked[:top] for c in (co - step, co + step)
+                                     if co_min <= c <= co_max and c not in scores]))
+        print('Adaptive sweep finished. Scores written to ' +
+              os.path.join(self.inimodel_runs_master, 'sweep_scores.txt'))
+
+    def write_sweep_scores(self, scores):
+        # Writes crossover scores of an adaptive sweep into the runs master folder
+        output = ''
+        for co in sorted(scores):
+            output += '{} = {}'.format(str(co) + 'co', scores[co]) + '\n'
+        self.write_file(output, os.path.join(self.inimodel_runs_master, 'sweep_scores.txt'))
 
+    @timed()
     def initialize_inimodel(self):
         # Checking setting
         for setting in self.inimodel_settings:
@@ -431,6 +956,7 @@ class Project:
         for setting in self.inimodel_settings:
             print(setting + ' = ' + str(self.settings[setting]))
         print('Modify settings in the settings file (' + self.settings_path + ')')
+        self.report_resource_suggestion('inimodel', int(self.settings['inimodel_crossover_range_min']))
 
         # Create new inimodel folder for the run
         # Set folder name
@@ -445,6 +971,8 @@ class Project:
 
         # Write inimodel settings
         self.write_inimodel_settings()
+        # Select class averages
+        self.prepare_class_averages()
 
         # Create job object and add it to the archive
         # Create inimodel job
@@ -460,36 +988,100 @@ class Project:
         self.job_counters['inimodel_counter'] += 1
         self.write_jobcounter()
 
-    def write_inimodel_submission(self, directory, crossover):
-        co = str(crossover)
-        # Build output string
-        submissionstring = '#!/bin/bash -l' + '\n'
-        submissionstring += '#SBATCH -D ' + directory + '/\n'
-        submissionstring += '#SBATCH -J inimodel' + '\n'
-        submissionstring += '#SBATCH -C scratch' + '\n'
-        submissionstring += '#SBATCH --partition=medium' + '\n'
-        submissionstring += '#SBATCH --error=' + directory + '/inimodel_' + co + 'co.err' + '\n'
-        submissionstring += '#SBATCH --output=' + directory + '/inimodel_' + co + 'co.out' + '\n'
-        submissionstring += '#SBATCH --ntasks=' + str(self.settings['inimodel_cpus']) + '\n'
-        submissionstring += '#SBATCH -t 02:00:00' + '\n'
-        submissionstring += '#SBATCH --qos=short' + '\n'
-        # Load relion module. Syntax might change in the future.
-        submissionstring += 'module purge' + '\n'
-        submissionstring += 'shopt -s expand_aliases' + '\n'
-        submissionstring += 'source /usr/users/rubsak/sw/rubsak.bashrc' + '\n'
-        submissionstring += 'use_relion4' + '\n'
-        submissionstring += '# load relion/4.0.0' + '\n'
-        submissionstring += 'echo - e "$(hostname) modules: $(module list 2>&1 | grep relion --color=never)"' + '\n'
-        # Get & write initial model command
-        submissionstring += self.write_inimodel_command(crossover)
-        # Write submission file
-        submission_file_name = self.date + '_' + co + 'co_submission.sh'
-        submission_file_path = os.path.join(directory, submission_file_name)
-        with open(submission_file_path, 'w') as fout:
-            fout.write(submissionstring)
-        return submission_file_path
-
-    def write_inimodel_command(self, crossover, inimodel_name=''):
+    def inimodel_resources(self, crossover):
+        # Time, cpu and memory (MB, None = default) requests, optionally from the resource history
+        time_request = '02:00:00'
+        cpus = self.settings['inimodel_cpus']
+        memory = None
+        if self.setting_is_true('general_autotune_resources'):
+            suggestion = self.suggest_resources('inimodel', crossover)
+            if suggestion is not None:
+                time_request, cpus, memory = suggestion['time'], suggestion['cpus'], suggestion['mem_mb']
+        return time_request, cpus, memory
+
+    @timed()
+    def prepare_class_averages(self):
+        # Writes the class average subset of this run into the runs master folder, if one is chosen
+        self.class_averages = None
+        if str(self.settings['inimodel_class_subset']).strip() in ('', 'all'):
+            return
+        slices = parse_selection(str(self.settings['inimodel_class_subset']))
+        subset_star = os.path.join(self.inimodel_runs_master, 'class_averages_subset.star')
+        subset_stack = self.settings['general_ca_mrc_location']
+        if self.setting_is_true('inimodel_class_subset_compact'):
+            subset_stack = os.path.join(self.inimodel_runs_master, 'class_averages_subset.mrcs')
+            rows = subset_class_averages(self.settings['general_ca_location'], slices, subset_star,
+                                         stack=self.settings['general_ca_mrc_location'], out_stack=subset_stack)
+        else:
+            rows = subset_class_averages(self.settings['general_ca_location'], slices, subset_star)
+        print('Using ' + str(rows) + ' class averages (' + subset_star + ').')
+        self.class_averages = (subset_star, subset_stack)
+
+    def get_class_averages(self):
+        # (.star file, stack) used by inimodel runs
+        if self.class_averages is not None:
+            return self.class_averages
+        return self.settings['general_ca_location'], self.settings['general_ca_mrc_location']
+
+    def render_inimodel_submission(self, directory, crossover):
+        # (submission file path, submission file content, inimodel command) of a crossover
+        # Resource requests, optionally from the resource history
+        time_request, cpus, memory = self.inimodel_resources(crossover)
+        # Stage class averages to node-local scratch
+        staging = ''
+        class_averages = None
+        if self.setting_is_true('general_stage_inputs'):
+            staging = self.write_staging_command()
+            class_averages = '"$STAGED_CA"'
+        command = self.write_inimodel_command(crossover, cpus=cpus, class_averages=class_averages)
+        submission = INIMODEL_SUBMISSION.substitute(
+            directory=directory, co=str(crossover), cpus=str(cpus), time_request=time_request,
+            memory='#SBATCH --mem=' + str(memory) + 'M' + '\n' if memory is not None else '',
+            modules=MODULES, staging=staging, command=command)
+        submission_file_path = os.path.join(directory, self.date + '_' + str(crossover) + 'co_submission.sh')
+        return submission_file_path, submission, command
+
+    def create_run_files(self, runs):
+        # runs: (folder, [(file, content), ...]) tuples, folders and files are created by a thread pool
+        def create(run):
+            folder, files = run
+            os.mkdir(folder)
+            for filename, content in files:
+                with open(filename, 'w') as fout:
+                    fout.write(content)
+
+        with self.events.stage('create_run_files', count=len(runs)):
+            with ThreadPoolExecutor(max_workers=FILE_WORKERS) as pool:
+                # list() re-raises errors of the workers
+                list(pool.map(create, runs))
+
+    def journal_commands(self, location, commands):
+        # Appends (label, command) pairs to command.log of location, earlier commands are kept
+        if len(commands) == 0:
+            return
+        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        journal = ''
+        for label, command in commands:
+            journal += '# ' + timestamp + ' ' + label + '\n' + command
+        with open(os.path.join(location, 'command.log'), 'a') as fout:
+            fout.write(journal)
+
+    def write_staging_command(self):
+        # Job script lines copying the class averages to node-local scratch once per node
+        # The staged .star file is stored in $STAGED_CA, the shared file is used if staging fails
+        star, stack = self.get_class_averages()
+        staging_command = '# Stage class averages to node-local scratch' + '\n'
+        staging_command += 'STAGED_CA=$(python3 ' + os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                   'staging.py') + ' \\\n'
+        staging_command += '--scratch "' + str(self.settings['general_scratch_dir']) + '" \\\n'
+        staging_command += '--star ' + star + ' \\\n'
+        staging_command += '--stack ' + stack + ' \\\n'
+        staging_command += '--star-checksum ' + self.digest_cache.digest(star) + ' \\\n'
+        staging_command += '--stack-checksum ' + self.digest_cache.digest(stack) + ') || STAGED_CA=' + star + '\n'
+        staging_command += 'echo "Using class averages $STAGED_CA"' + '\n'
+        return staging_command
+
+    def write_inimodel_command(self, crossover, inimodel_name='', cpus=None, class_averages=None):
         # Get values
         ini_iter = self.settings['inimodel_iter']
         mask = self.settings['inimodel_mask']
@@ -499,8 +1091,10 @@ class Project:
         sym = self.settings['inimodel_sym']
         max_res = self.settings['inimodel_max_res']
         px_size = self.settings['general_px_size']
-        class_averages = self.settings['general_ca_location']
-        cpus = self.settings['inimodel_cpus']
+        if class_averages is None:
+            class_averages = self.get_class_averages()[0]
+        if cpus is None:
+            cpus = self.settings['inimodel_cpus']
         # If not specified, set output-model name
         if inimodel_name == '':
             inimodel_name = str(crossover) + 'co_initial_model'
@@ -518,16 +1112,12 @@ class Project:
         inimodel_command += '--sym ' + str(sym) + ' \\\n'
         inimodel_command += '--maxres ' + str(max_res) + ' \\\n'
         inimodel_command += '--j ' + str(cpus) + ' \n'
-        # Write command into log file of master folder
-        log_file_name = os.path.join(self.inimodel_runs_master, 'command.log')
-        self.write_file(inimodel_command, log_file_name)
         return inimodel_command
 
     def inimodel_submit(self):
-        for file in self.inimodel_submission_file_paths:
-            print("Submitting " + file + " to hpc.")
-            cmd_string = 'sbatch ' + file
-            subprocess.run(cmd_string, shell=True, text=True, check=True)
+        job_ids = self.submit_jobs(self.inimodel_submission_file_paths)
+        self.record_job_ids(self.inimodel_runs_master, self.inimodel_submission_file_paths, job_ids)
+        return job_ids
 
     def write_inimodel_settings(self):
         output = ''
@@ -542,6 +1132,7 @@ class Project:
 
     # Refinement functions
 
+    @timed()
     def refine(self):
         # Create necessary folders / files
         # Write submission file
@@ -549,47 +1140,177 @@ class Project:
 
         # Select initial models to refine
         self.load_inimodels()
+        # Fail before anything is archived if the particles cannot be split
+        self.check_particle_subsets()
         # Initialize refinement settings, folders and archive
         self.initialize_refine()
         # For each loaded initial model, create subfolder & write submission file into it
 
+        # Bring the initial models to the pixel size and box of the particles
+        self.rescale_references()
+        # Without subsets, every crossover gets one refinement of all particles
+        subsets = self.split_particles()
         self.refine_submission_file_paths = []
+        runs = []
+        commands = []
         for co in self.co_selection:
-            refine_run_name = co + '_refine'
-            refine_run_folder = os.path.join(self.refine_runs_master, refine_run_name)
-            os.mkdir(refine_run_folder)
-            # Calculate twist
-            co = int(co[:-2])
-            submission_file = self.write_refine_submission(directory=refine_run_folder, crossover=co)
-            self.refine_submission_file_paths.append(submission_file)
+            for subset in sorted(subsets, key=lambda key: int(key) if key.isdigit() else 0):
+                label = co if subset == '' else co + '_' + self.settings['refine_subset_mode'] + subset
+                refine_run_folder = os.path.join(self.refine_runs_master, label + '_refine')
+                submission_file, submission, command = self.render_refine_submission(
+                    refine_run_folder, int(co[:-2]), label=label, particles=subsets[subset])
+                runs.append((refine_run_folder, [(submission_file, submission)]))
+                commands.append((label + '_refine', command))
+                self.refine_submission_file_paths.append(submission_file)
+        self.create_run_files(runs)
+        self.journal_commands(self.refine_runs_master, commands)
 
         # Submit jobs to the hpc
         self.refine_submit()
 
+    def check_particle_subsets(self):
+        # Raises ValueError if refine_subset_mode is unknown or refine_particles lacks the columns it needs
+        for setting in ('refine_particles', 'refine_subset_mode'):
+            if self.settings[setting] == '':
+                print('Please specify ' + setting + ':')
+                self.settings[setting] = input('')
+        mode = str(self.settings['refine_subset_mode'])
+        if mode == 'none':
+            return
+        if mode not in SPLIT_MODES:
+            raise ValueError('Unknown refine_subset_mode ' + mode + '. Available: none, ' + ', '.join(SPLIT_MODES))
+        particles = self.settings['refine_particles']
+        if not os.path.exists(particles):
+            raise ValueError('refine_particles ' + particles + ' does not exist.')
+        with open(particles) as fin:
+            columns = Star(particles, parse=False).read_loop_header(fin)[1]
+        missing = [column for column in SPLIT_COLUMNS[mode] if column not in columns]
+        if len(missing) > 0:
+            raise ValueError('refine_subset_mode ' + mode + ' needs the column(s) ' + ', '.join(missing) +
+                             ', which ' + particles + ' does not have. Set refine_subset_mode to none or ' +
+                             'another mode.')
+
+    @timed()
+    def split_particles(self):
+        # Particle files to refine {subset: file}, {'': refine_particles} without subsets
+        # The mode and the particle columns are checked by check_particle_subsets
+        mode = str(self.settings['refine_subset_mode'])
+        if mode in ('', 'none'):
+            return {'': self.settings['refine_particles']}
+        subset_folder = os.path.join(self.refine_runs_master, 'particle_subsets')
+        os.mkdir(subset_folder)
+        star = Star(self.settings['refine_particles'], parse=False)
+        subsets = star.split(subset_folder, by=mode, n=int(self.settings['refine_subset_count']))
+        selection = str(self.settings['refine_subset_select'])
+        if selection not in ('', 'all'):
+            wanted = set([str(number) for number in parse_selection(selection)])
+            subsets = dict([(key, subsets[key]) for key in subsets if key in wanted])
+        print('Refining ' + str(len(subsets)) + ' ' + mode + ' subsets of ' + self.settings['refine_particles'])
+        return subsets
+
+    def refine_target_geometry(self):
+        # (pixel size, box) of the refinement, None if the initial models are used as they are
+        px_size = str(self.settings['refine_px_size'])
+        box = str(self.settings['refine_box_size'])
+        if px_size == 'none' or box == 'none':
+            return None
+        if px_size in ('', 'auto') or box in ('', 'auto'):
+            optics = Star(self.settings['refine_particles'], parse=False).read_optics()
+            if len(optics) == 0 or 'rlnImagePixelSize' not in optics[0] or 'rlnImageSize' not in optics[0]:
+                print('No pixel size / box in the optics block of ' + self.settings['refine_particles'] +
+                      '. Using the initial models as they are (set refine_px_size and refine_box_size).')
+                return None
+            if px_size in ('', 'auto'):
+                px_size = optics[0]['rlnImagePixelSize']
+            if box in ('', 'auto'):
+                box = optics[0]['rlnImageSize']
+        return float(px_size), int(box)
+
+    @timed()
+    def rescale_references(self):
+        '''
+        Rescales the selected initial models to the pixel size and box of the refinement.
+        Results are cached in project/rescale_cache under a hash of the model and the target,
+        only missing ones are computed (in parallel processes).
+        '''
+        self.rescaled_references = dict()
+        target = self.refine_target_geometry()
+        if target is None or str(self.settings['refine_reference']) not in ('', 'auto'):
+            return self.rescaled_references
+        px_size, box = target
+        if not os.path.exists(self.rescale_cache):
+            os.mkdir(self.rescale_cache)
+        jobs = []
+        for inimodel_file in self.inimodels_for_refine:
+            # Header pixel size, the class average pixel size for models without one
+            input_px_size = MrcFile(inimodel_file).voxel_size
+            if input_px_size <= 0:
+                input_px_size = float(self.settings['general_px_size'])
+            parameters = dict(px_size=px_size, box=box, input_px_size=input_px_size)
+            job_hash = inputs_hash([self.digest_cache.digest(inimodel_file)], parameters, 'rescale')
+            name = os.path.basename(inimodel_file)[:-len('.mrc')] + '_' + job_hash[:16] + '.mrc'
+            rescaled_file = os.path.join(self.rescale_cache, name)
+            self.rescaled_references[inimodel_file] = rescaled_file
+            if not os.path.exists(rescaled_file):
+                jobs.append((inimodel_file, rescaled_file, px_size, box, input_px_size))
+        rescale_maps(jobs, workers=min(len(jobs), os.cpu_count() or 1))
+        print('Rescaled ' + str(len(jobs)) + ' initial models to ' + str(px_size) + ' A/px, box ' + str(box) +
+              ' (' + str(len(self.rescaled_references) - len(jobs)) + ' cached)')
+        return self.rescaled_references
+
+    @timed()
     def load_inimodels(self):
         # List jobs from archive
         self.list_jobs(inimodel=True)
         selection = int(input("Please select INIMODEL job: "))
         # Load settings of specified job
         self.read_settings(self.archive['inimodel_jobs'][selection].settings_file)
-        # Ask user which models to load
-        self.inimodels_for_refine = []
-        co_range_string = ''
-        for i in range(int(self.settings['inimodel_crossover_range_min']),
-                       int(self.settings['inimodel_crossover_range_max']) +
-                       int(self.settings['inimodel_crossover_step']),
-                       int(self.settings['inimodel_crossover_step'])):
-            co_range_string += str(i) + ' '
-        print("Found the following crossover range: ")
-        print(co_range_string)
+        # Rank all runs of the job (adaptive sweeps do not follow a regular grid, so scan the run folders)
+        location = self.archive['inimodel_jobs'][selection].location
+        harvester = InimodelHarvester(location, metric=self.settings['inimodel_adaptive_metric'])
+        ranking = harvester.harvest()
+        print("Found the following crossover runs: ")
+        print(harvester.table_to_string(ranking))
+        # Group nearly identical initial models
+        representatives = self.select_representatives(harvester, len(ranking))
+        print("Proposed crossovers (best of each group of similar initial models): " + ' '.join(representatives))
         # Get user information, save initial model location in self.inimodels_for_refine
-        co_selection_string = input("Please specify which crossover models to choose " +
-                                    "for refinement (seperate multiple entries with a whitespace): ")
-        self.co_selection = [x + 'co' for x in co_selection_string.strip().split()]
-        for e in self.co_selection:
-            inimodel_file = os.path.join(self.archive['inimodel_jobs'][selection].location, e, e + '_initial_model.mrc')
-            self.inimodels_for_refine.append(inimodel_file)
-
+        # Asked again until all selected initial models exist, nothing is archived before
+        while True:
+            co_selection_string = input("Please specify which crossover models to choose " +
+                                        "for refinement (seperate multiple entries with a whitespace, " +
+                                        "or 'top N' for the N best proposed runs): ")
+            if co_selection_string.strip().startswith('top'):
+                values = co_selection_string.split()
+                if len(values) != 2 or not values[1].isdigit():
+                    print("Please give the number of runs, e.g. 'top 3'.")
+                    continue
+                self.co_selection = representatives[:int(values[1])]
+                print('Selected ' + ' '.join(self.co_selection))
+            else:
+                self.co_selection = [x + 'co' for x in co_selection_string.strip().split()]
+            self.inimodels_for_refine = [os.path.join(location, e, e + '_initial_model.mrc')
+                                         for e in self.co_selection]
+            missing = [e for e, inimodel_file in zip(self.co_selection, self.inimodels_for_refine)
+                       if not os.path.exists(inimodel_file)]
+            if len(self.co_selection) > 0 and len(missing) == 0:
+                break
+            if len(missing) > 0:
+                print('No initial model found for ' + ' '.join(missing) + '. Please select finished runs.')
+            else:
+                print('Please select at least one crossover.')
+
+    @timed()
+    def select_representatives(self, harvester, n):
+        # Best n finished runs, skipping runs whose initial model is nearly identical to an already chosen one
+        finished = harvester.top()
+        threshold = float(self.settings['refine_similarity_threshold'])
+        if threshold <= 0 or len(finished) < 2:
+            return finished[:n]
+        model_files = [run_model_file(os.path.join(harvester.location, e), e[:-2]) for e in finished]
+        return [finished[i] for i in select_distinct(model_files, n, threshold=threshold)]
+
+    @timed()
     def initialize_refine(self):
         # Checking setting
         # TODO refinement standard settings
@@ -605,6 +1326,9 @@ class Project:
         for setting in self.refine_settings:
             print(setting + ' = ' + str(self.settings[setting]))
         print('Modify settings in the settings file (' + self.settings_path + ')')
+        self.refine_layout(warn=True)
+        first_selection = self.co_selection[0][:-2]
+        self.report_resource_suggestion('refine', int(first_selection) if first_selection.isdigit() else 0)
 
         # Create new refinement folder for the run
         # Set folder name
@@ -645,114 +1369,225 @@ class Project:
     def read_refine_settings(self, settingsfile):
         self.read_settings(settingsfile)
 
-    def write_refine_submission(self, directory, crossover):
-        co = str(crossover)
-        twist = self.calc_twist(crossover)
-        # Build output string
-        submissionstring = '#!/bin/bash -l' + '\n'
-        submissionstring += '#SBATCH -D ' + directory + '/\n'
-        submissionstring += '#SBATCH -J refine' + '\n'
-        submissionstring += '#SBATCH -C scratch' + '\n'
-        submissionstring += '#SBATCH --partition=gpu' + '\n'
-        submissionstring += '#SBATCH --error=' + directory + '/refine_' + co + 'co.err' + '\n'
-        submissionstring += '#SBATCH --output=' + directory + '/refine_' + co + 'co.out' + '\n'
-        submissionstring += '# Ressource settings'
-        submissionstring += '#SBATCH --gres=gpu:' + str(self.settings['refine_gpu']) + '\n'
-        submissionstring += '#SBATCH --cpus-per-task=' + str(self.settings['refine_cpus']) + '\n'
-        submissionstring += '#SBATCH --nodes=' + str(self.settings['refine_nodes']) + '\n'
-        submissionstring += '#SBATCH --ntasks=' + str(self.settings['refine_mpis']) + '\n'
-        submissionstring += '#SBATCH --mem-per-cpu=' + str(self.settings['refine_mem_cpu']) + '\n'
-        submissionstring += '#SBATCH -t 48:00:00' + '\n'
-        # Load relion module. Syntax might change in the future.
-        submissionstring += 'module purge' + '\n'
-        submissionstring += 'shopt -s expand_aliases' + '\n'
-        submissionstring += 'source /usr/users/rubsak/sw/rubsak.bashrc' + '\n'
-        submissionstring += 'use_relion4' + '\n'
-        submissionstring += '# load relion/4.0.0' + '\n'
-        submissionstring += 'echo - e "$(hostname) modules: $(module list 2>&1 | grep relion --color=never)"' + '\n'
-        # Get & write refinement command
-        submissionstring += 'mpirun ' + self.write_refine_command(crossover)
-        # Write submission file
-        submission_file_name = self.date + '_' + co + 'co_submission.sh'
-        submission_file_path = os.path.join(directory, submission_file_name)
-        with open(submission_file_path, 'w') as fout:
-            fout.write(submissionstring)
-        return submission_file_path
-
-    def write_refine_command(self, crossover):
-        # Get values
-        ini_iter = self.settings['inimodel_iter']
-        mask = self.settings['inimodel_mask']
-        shift = self.settings['inimodel_shift']
-        angle = self.settings['inimodel_angle']
-        step = self.settings['inimodel_angle_step']
-        sym = self.settings['inimodel_sym']
-        max_res = self.settings['inimodel_max_res']
-        px_size = self.settings['general_px_size']
-        class_averages = self.settings['general_ca_location']
-        cpus = self.settings['inimodel_cpus']
-        # Build command
-        refine_command = 'relion_helix_inimodel2d ' + '\\\n'
-        refine_command += '--i ' + class_averages + ' \\\n'
-        refine_command += '--o ' + inimodel_name + ' \\\n'
-        refine_command += '--angpix ' + str(px_size) + ' \\\n'
-        refine_command += '--iter ' + str(ini_iter) + ' \\\n'
-        refine_command += '--mask_diameter ' + str(mask) + ' \\\n'
-        refine_command += '--search_shift ' + str(shift) + ' \\\n'
-        refine_command += '--search_angle ' + str(angle) + ' \\\n'
-        refine_command += '--step_angle ' + str(step) + ' \\\n'
-        refine_command += '--sym ' + str(sym) + ' \\\n'
-        refine_command += '--maxres ' + str(max_res) + ' \\\n'
-        refine_command += '--j ' + str(cpus) + ' \n'
-        # Write command into log file of master folder
-        log_file_name = os.path.join(self.refine_runs_master, 'command.log')
-        self.write_file(refine_command, log_file_name)
+    def render_refine_submission(self, directory, crossover, label=None, command=None, particles=None):
+        # (submission file path, submission file content, refinement command or None if command is given)
+        # label: name used for log and submission files (default <crossover>co)
+        # command: command to run instead of the refinement command of the crossover
+        # particles: particle file to refine (default refine_particles)
+        if label is None:
+            label = str(crossover) + 'co'
+        # Time and memory requests, optionally from the resource history
+        time_request = '48:00:00'
+        memory_per_cpu = self.settings['refine_mem_cpu']
+        if self.setting_is_true('general_autotune_resources'):
+            suggestion = self.suggest_resources('refine', crossover)
+            if suggestion is not None:
+                time_request = suggestion['time']
+                if suggestion['mem_mb'] is not None:
+                    # Max RSS is per task, request it per cpu
+                    memory_per_cpu = max(1, suggestion['mem_mb'] // max(1, int(self.settings['refine_cpu'])))
+        refine_command = None
+        if command is None:
+            refine_command = self.write_refine_command(crossover, directory=directory, particles=particles)
+            command = 'mpirun ' + refine_command
+        submission = REFINE_SUBMISSION.substitute(
+            directory=directory, label=label, gpu=str(self.settings['refine_gpu']),
+            cpu=str(self.settings['refine_cpu']), nodes=str(self.settings['refine_nodes']),
+            ntasks=str(self.refine_layout()['mpis']), memory_per_cpu=str(memory_per_cpu),
+            time_request=time_request, modules=MODULES, command=command)
+        submission_file_path = os.path.join(directory, self.date + '_' + label + '_submission.sh')
+        return submission_file_path, submission, refine_command
+
+    def write_refine_command(self, crossover, directory=None, particles=None):
         '''
-                # 3D REFINE COMMAND
-                    mpirun `which relion_refine_mpi`\
-                     --o Refine3D/900_3dref_result\
-                     --auto_refine\
-                     --split_random_halves\
-                     --i Select/job043/particles.star\
-                     --ref 220530_crossover_range_4refine/inimodels/bin3/900co_768px_bin3.mrc\
-                     --ini_high 10\
-                     --dont_combine_weights_via_disc\
-                     --pool 30\
-                     --pad 2\
-                     --skip_gridding\
-                     --ctf\
-                     --particle_diameter 220\
-                     --flatten_solvent\
-                     --zero_mask\
-                     --oversampling 1\
-                     --healpix_order 3\
-                     --auto_local_healpix_order 4\
-                     --offset_range 5\
-                     --offset_step 2\
-                     --sym C1\
-                     --low_resol_join_halves 40\
-                     --norm\
-                     --scale\
-                     --helix\
-                     --helical_outer_diameter 180\
-                     --helical_nr_asu 3\
-                     --helical_twist_initial -0.95\
-                     --helical_rise_initial 4.75\
-                     --helical_z_percentage 0.17\
-                     --sigma_tilt 5\
-                     --sigma_psi 3.33333\
-                     --sigma_rot 0\
-                     --helical_keep_tilt_prior_fixed\
-                     --j 8\
-                     --gpu "0:1:2:3"
-                '''
+        relion_refine_mpi command of one crossover, every refine_* setting mapped to its option.
+        GPU layout, threads and pool are derived from the allocation (see refine_layout).
+        '''
+        if directory is None:
+            directory = os.path.join(self.refine_runs_master, str(crossover) + 'co_refine')
+        layout = self.refine_layout()
+        # Reference: selected initial model of this crossover, unless given explicitly
+        reference = str(self.settings['refine_reference'])
+        if reference in ('', 'auto'):
+            reference = self.refine_reference(crossover)
+        if particles is None:
+            particles = self.settings['refine_particles']
+        twist = str(self.settings['refine_helical_twist_initial'])
+        if twist in ('', 'auto'):
+            twist = str(round(-self.calc_twist(crossover), 4))
+        # Build command
+        refine_command = 'relion_refine_mpi ' + '\\\n'
+        refine_command += '--o ' + os.path.join(directory, 'run') + ' \\\n'
+        refine_command += '--i ' + str(particles) + ' \\\n'
+        refine_command += '--ref ' + reference + ' \\\n'
+        for setting, option in self.refine_switches:
+            if self.setting_is_true(setting):
+                refine_command += option + ' \\\n'
+        for setting, option in self.refine_options:
+            if str(self.settings[setting]) != '':
+                refine_command += option + ' ' + str(self.settings[setting]) + ' \\\n'
+        if self.setting_is_true('refine_helix'):
+            refine_command += '--helical_twist_initial ' + twist + ' \\\n'
+            for setting, option in self.refine_helical_options:
+                if str(self.settings[setting]) != '':
+                    refine_command += option + ' ' + str(self.settings[setting]) + ' \\\n'
+        refine_command += '--pool ' + str(layout['pool']) + ' \\\n'
+        refine_command += '--j ' + str(layout['threads'])
+        if layout['gpu'] != '':
+            refine_command += ' \\\n' + '--gpu "' + layout['gpu'] + '"'
+        refine_command += ' \n'
         return refine_command
 
-    def refine_submit(self):
-        for file in self.refine_submission_file_paths:
-            print("Submitting " + file + " to hpc.")
-            cmd_string = 'sbatch ' + file
-            subprocess.run(cmd_string, shell=True, text=True, check=True)
+    def refine_layout(self, warn=False):
+        '''
+        MPI / GPU layout of a refinement:
+        - mpis 'auto': one leader rank plus one worker rank per GPU of every node
+        - refine_gpu 0: CPU only, no --gpu, mpis 'auto' two worker ranks per node, at least MIN_CPU_MPIS
+        - gpu: worker ranks of a node are assigned to its GPUs round robin ("0:1:2:3")
+        - threads (--j): cpus per task (refine_cpu)
+        - pool 'auto': 4 particles per thread, at least 30
+        '''
+        nodes = int(self.settings['refine_nodes'])
+        gpus = int(self.settings['refine_gpu'])
+        threads = int(self.settings['refine_cpu'])
+        mpis = str(self.settings['refine_mpis'])
+        if mpis in ('', 'auto'):
+            # Without GPUs two worker ranks per node
+            mpis = nodes * (gpus if gpus > 0 else 2) + 1
+        mpis = int(mpis)
+        if gpus == 0:
+            if warn:
+                print('Warning: refine_gpu is 0, relion_refine_mpi runs on CPUs only (no --gpu).')
+            if mpis < MIN_CPU_MPIS:
+                if warn:
+                    print('Warning: ' + str(mpis) + ' MPI ranks are too few for a CPU refinement, using ' +
+                          str(MIN_CPU_MPIS) + '.')
+                mpis = MIN_CPU_MPIS
+        # The leader rank (rank 0) does no GPU work
+        workers_per_node = -(-(mpis - 1) // nodes)
+        if warn and 0 < workers_per_node < gpus:
+            print('Warning: ' + str(workers_per_node) + ' worker ranks per node leave ' +
+                  str(gpus - workers_per_node) + ' of ' + str(gpus) + ' GPUs idle. ' +
+                  'Set refine_mpis to ' + str(nodes * gpus + 1) + ' (or auto).')
+        gpu = ':'.join([str(rank % gpus) for rank in range(workers_per_node)]) if gpus > 0 else ''
+        pool = str(self.settings['refine_pool'])
+        if pool in ('', 'auto'):
+            pool = max(30, 4 * threads)
+        return dict(mpis=mpis, gpu=gpu, threads=threads, pool=int(pool))
+
+    def refine_reference(self, crossover):
+        # Selected initial model of a crossover, rescaled to the refinement box if available
+        for inimodel_file in self.inimodels_for_refine:
+            if os.path.basename(inimodel_file) == str(crossover) + 'co_initial_model.mrc':
+                return self.rescaled_references.get(inimodel_file, inimodel_file)
+        raise ValueError('No initial model selected for crossover ' + str(crossover))
+
+    def refine_submit(self, dependency=''):
+        job_ids = self.submit_jobs(self.refine_submission_file_paths, dependency=dependency)
+        self.record_job_ids(self.refine_runs_master, self.refine_submission_file_paths, job_ids)
+        return job_ids
+
+    # Pipeline functions
+    @timed()
+    def pipeline(self):
+        '''
+        Submits the whole inimodel -> refine chain at once:
+        - inimodel runs of the crossover range
+        - a small selection job (afterany: all inimodel runs), which ranks the finished runs and writes
+          the refinement commands of the refine_pipeline_top best crossovers
+        - refine_pipeline_top refinement slots (afterany: selection job), which run the commands the
+          selection job wrote for them and fail right away if the selection job wrote none
+        '''
+        # Inimodel part
+        print('Initializing inimodel settings.')
+        self.initialize_inimodel()
+        if self.settings['inimodel_sweep_mode'] == 'adaptive':
+            print('Adaptive sweeps need to wait for their results. Submitting the full crossover range instead.')
+        self.create_inimodel_runs(self.get_crossover_range())
+        inimodel_job_ids = self.inimodel_submit()
+        inimodel_location = self.inimodel_runs_master
+
+        # Refinement part, crossovers are chosen later by the selection job
+        top = int(self.settings['refine_pipeline_top'])
+        self.co_selection = ['top' + str(top)]
+        self.initialize_refine()
+
+        # Selection job
+        selection_file = self.write_selection_submission(inimodel_location)
+        # All crossovers may have been reused, then there is nothing to wait for
+        dependency = ''
+        if len(inimodel_job_ids) > 0:
+            dependency = 'afterany:' + ':'.join(inimodel_job_ids)
+        selection_job_ids = self.submit_jobs([selection_file], dependency=dependency)
+        self.record_job_ids(self.refine_runs_master, [selection_file], selection_job_ids)
+
+        # Refinement slots
+        self.refine_submission_file_paths = []
+        runs = []
+        for slot in range(1, top + 1):
+            slot_folder = os.path.join(self.refine_runs_master, self.pipeline_slot_name(slot))
+            # afterany: a failed selection job leaves the slot without command instead of pending forever
+            slot_file = os.path.join(slot_folder, 'refine_command.sh')
+            slot_command = 'if [ -f ' + slot_file + ' ]; then source ' + slot_file + '; ' + \
+                           'else echo "No refinement command, the selection job failed." >&2; exit 1; fi'
+            submission_file, submission, command = self.render_refine_submission(
+                slot_folder, None, label='slot' + str(slot), command=slot_command)
+            runs.append((slot_folder, [(submission_file, submission)]))
+            self.refine_submission_file_paths.append(submission_file)
+        self.create_run_files(runs)
+        self.refine_submit(dependency='afterany:' + selection_job_ids[0])
+        print('Submitted pipeline. Refinements start as soon as the selection job ' + selection_job_ids[0] +
+              ' has finished.')
+
+    def pipeline_slot_name(self, slot):
+        return 'slot' + str(slot) + '_refine'
+
+    def write_selection_submission(self, inimodel_location):
+        # Submission file of the selection job, which calls this script in 'select' mode
+        script = os.path.abspath(__file__)
+        submissionstring = '#!/bin/bash -l' + '\n'
+        submissionstring += '#SBATCH -D ' + self.workdir + '/\n'
+        submissionstring += '#SBATCH -J select' + '\n'
+        submissionstring += '#SBATCH --partition=medium' + '\n'
+        submissionstring += '#SBATCH --error=' + self.refine_runs_master + '/select.err' + '\n'
+        submissionstring += '#SBATCH --output=' + self.refine_runs_master + '/select.out' + '\n'
+        submissionstring += '#SBATCH --ntasks=1' + '\n'
+        submissionstring += '#SBATCH -t 00:15:00' + '\n'
+        submissionstring += '#SBATCH --qos=short' + '\n'
+        submissionstring += 'python3 ' + script + ' select ' + self.project_folder + ' ' + \
+                            inimodel_location + ' ' + self.refine_runs_master + '\n'
+        submission_file_path = os.path.join(self.refine_runs_master, self.date + '_select_submission.sh')
+        self.write_file(submissionstring, submission_file_path)
+        return submission_file_path
+
+    @timed()
+    def pipeline_select(self, inimodel_location, refine_runs_master):
+        # Runs inside the selection job: rank inimodel runs, write the refine commands of the slots
+        self.refine_runs_master = refine_runs_master
+        self.read_settings(os.path.join(inimodel_location, 'inimodel_settings.txt'))
+        self.read_settings(os.path.join(refine_runs_master, 'refine_settings.txt'))
+        top = int(self.settings['refine_pipeline_top'])
+        harvester = InimodelHarvester(inimodel_location, metric=self.settings['inimodel_adaptive_metric'])
+        self.co_selection = self.select_representatives(harvester, top)
+        print(harvester.table_to_string())
+        print('Selected ' + ' '.join(self.co_selection))
+        self.inimodels_for_refine = [os.path.join(inimodel_location, e, e + '_initial_model.mrc')
+                                     for e in self.co_selection]
+        self.write_file('\n'.join(self.co_selection) + '\n', os.path.join(refine_runs_master, 'selection.txt'))
+        self.rescale_references()
+        commands = []
+        for slot in range(1, len(self.co_selection) + 1):
+            slot_folder = os.path.join(refine_runs_master, self.pipeline_slot_name(slot))
+            crossover = int(self.co_selection[slot - 1][:-2])
+            command = self.write_refine_command(crossover, directory=slot_folder)
+            self.write_file('mpirun ' + command, os.path.join(slot_folder, 'refine_command.sh'))
+            commands.append((self.pipeline_slot_name(slot), command))
+        self.journal_commands(refine_runs_master, commands)
+        # Slots without a crossover (fewer finished runs than requested) end right away
+        for slot in range(len(self.co_selection) + 1, top + 1):
+            slot_folder = os.path.join(refine_runs_master, self.pipeline_slot_name(slot))
+            self.write_file('echo "No crossover selected for this slot."\n',
+                            os.path.join(slot_folder, 'refine_command.sh'))
 
 
 class Job():
@@ -773,6 +1608,22 @@ class Job():
 
 
 if __name__ == '__main__':
-    project = Project()
-    work_dir = project.workdir
-    date = project.date
+    parser = argparse.ArgumentParser(description='Helical initial model generation and 3D refinement.')
+    subparsers = parser.add_subparsers(dest='command')
+    select_parser = subparsers.add_parser('select', help='Select the best crossovers of an inimodel job and '
+                                                         'write the refinement commands of a pipeline')
+    select_parser.add_argument('project_folder')
+    select_parser.add_argument('inimodel_location')
+    select_parser.add_argument('refine_runs_master')
+    status_parser = subparsers.add_parser('status', help='Status of all projects of a working directory')
+    status_parser.add_argument('workdir', nargs='?', default=os.getcwd())
+    args = parser.parse_args()
+    if args.command == 'status':
+        print(dashboard.rows_to_string(dashboard.project_status(args.workdir)))
+    elif args.command == 'select':
+        project = Project(project_folder=args.project_folder, job='select')
+        project.pipeline_select(args.inimodel_location, args.refine_runs_master)
+    else:
+        project = Project()
+        work_dir = project.workdir
+        date = project.date
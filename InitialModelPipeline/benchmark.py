@@ -0,0 +1,329 @@
+import argparse
+import builtins
+import contextlib
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+from harvester import InimodelHarvester
+
+'''
+GOAL
+    - Exercise Project end to end without a cluster: fake sbatch / squeue / sacct and a fake relion_helix_inimodel2d
+    - Drive project creation, settings load, folder and script generation, submission, status polling,
+      result harvesting and the pipeline selection job for sweeps of different sizes
+    - Check that the selection job fills the refinement slots of a pipeline from the finished runs
+    - Report time and filesystem operations per stage, and how much the project folder grew
+
+USAGE
+    - python3 benchmark.py                       # sweeps of 10, 100 and 1000 crossovers
+    - python3 benchmark.py --sizes 10 50 --keep  # keep the temporary working directories
+    - python3 benchmark.py --pack-size 8         # pack 8 crossovers into one job
+'''
+
+FAKE_SBATCH = '''#!{python}
+# Fake sbatch: assigns a job id and runs the job script in the background
+import os
+import subprocess
+import sys
+import time
+
+state = os.environ['FAKE_SLURM_DIR']
+if sys.argv[1] == '--run':
+    job_id, script, directory, output, error = sys.argv[2:7]
+    start = time.time()
+    with open(output, 'w') as fout, open(error, 'w') as ferr:
+        subprocess.run(['bash', script], cwd=directory, stdout=fout, stderr=ferr)
+    with open(os.path.join(directory, 'usage.txt'), 'w') as fout:
+        fout.write('elapsed_s = ' + str(time.time() - start) + '\\n')
+        fout.write('max_rss_mb = 10\\ncpu_efficiency = 1.0\\ncpus = 1\\nstate = COMPLETED\\n')
+    open(os.path.join(state, 'done', job_id), 'w').close()
+    sys.exit(0)
+
+script = sys.argv[-1]
+counter_file = os.path.join(state, 'counter')
+job_id = str(int(open(counter_file).read()) + 1) if os.path.exists(counter_file) else '1'
+with open(counter_file, 'w') as fout:
+    fout.write(job_id)
+directory = os.getcwd()
+output = error = os.devnull
+with open(script) as fin:
+    for line in fin:
+        if not line.startswith('#SBATCH'):
+            continue
+        option = line.split()[1:]
+        if option[0] == '-D':
+            directory = option[1].rstrip('/')
+        elif option[0].startswith('--output='):
+            output = option[0].split('=', 1)[1]
+        elif option[0].startswith('--error='):
+            error = option[0].split('=', 1)[1]
+subprocess.Popen([sys.executable, __file__, '--run', job_id, script, directory, output, error],
+                 start_new_session=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                 stderr=subprocess.DEVNULL)
+print(job_id)
+'''
+
+FAKE_SQUEUE = '''#!{python}
+# Fake squeue: prints the ids of all requested jobs that have not finished
+import os
+import sys
+
+state = os.environ['FAKE_SLURM_DIR']
+job_ids = sys.argv[sys.argv.index('-j') + 1].split(',')
+for job_id in job_ids:
+    if not os.path.exists(os.path.join(state, 'done', job_id)):
+        print(job_id)
+'''
+
+FAKE_SACCT = '''#!{python}
+# Fake sacct: not available, so the usage.txt stand-in is used
+import sys
+sys.exit(1)
+'''
+
+FAKE_INIMODEL = '''#!{python}
+# Fake relion_helix_inimodel2d: writes a tiny initial model, the score peaks at crossover {optimum}
+import struct
+import sys
+
+args = sys.argv[1:]
+output = args[args.index('--o') + 1]
+crossover = float(args[args.index('--crossover_distance') + 1])
+score = -((crossover - {optimum}) / 100.0) ** 2
+print(' Iteration 1; score= ' + str(score - 1.0))
+print(' Iteration 2; score= ' + str(score))
+header = bytearray(1024)
+struct.pack_into('<4i', header, 0, 8, 8, 8, 2)
+header[208:212] = b'MAP '
+header[212:216] = b'\\x44\\x44\\x00\\x00'
+struct.pack_into('<f', header, 216, 1.0 + score)
+with open(output + '.mrc', 'wb') as fout:
+    fout.write(bytes(header) + bytes(8 * 8 * 8 * 4))
+with open(output + '.star', 'w') as fout:
+    fout.write('data_\\n_rlnCrossover ' + str(crossover) + '\\n')
+'''
+
+
+class FileSystemCounter:
+    '''
+    Counts file system calls of this process while it is active.
+    '''
+
+    FUNCTIONS = [(builtins, 'open'), (os, 'mkdir'), (os, 'makedirs'), (os, 'symlink'), (os, 'replace'),
+                 (os, 'listdir'), (os, 'scandir'), (os, 'stat')]
+
+    def __init__(self):
+        self.counts = dict()
+        self.originals = dict()
+
+    def __enter__(self):
+        for module, name in self.FUNCTIONS:
+            original = getattr(module, name)
+            self.originals[(module, name)] = original
+            setattr(module, name, self.wrap(name, original))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for (module, name), original in self.originals.items():
+            setattr(module, name, original)
+        return False
+
+    def wrap(self, name, function):
+        def counted(*args, **kwargs):
+            key = name
+            if name == 'open':
+                mode = args[1] if len(args) > 1 else kwargs.get('mode', 'r')
+                key = 'open_read' if mode.startswith('r') else 'open_write'
+            self.counts[key] = self.counts.get(key, 0) + 1
+            return function(*args, **kwargs)
+
+        return counted
+
+    def snapshot(self):
+        return dict(self.counts)
+
+
+class Benchmark:
+    '''
+    One dry run of a crossover sweep in a temporary working directory.
+    '''
+
+    def __init__(self, crossovers, keep=False, pack_size=1):
+        self.crossovers = crossovers
+        self.pack_size = pack_size
+        self.keep = keep
+        self.workdir = tempfile.mkdtemp(prefix='ini3dr_benchmark_')
+        self.stages = []
+        self.counter = FileSystemCounter()
+        self.answers = []
+
+    def run(self):
+        # Imported here, the fake executables have to be on the PATH first
+        from InitialModelMaster import Project
+
+        old_cwd = os.getcwd()
+        old_path = os.environ.get('PATH', '')
+        old_input = builtins.input
+        try:
+            self.setup_fake_cluster()
+            os.chdir(self.workdir)
+            builtins.input = self.answer
+            co_min = 100
+            co_max = co_min + 10 * (self.crossovers - 1)
+            optimum = co_min + 10 * (self.crossovers // 2)
+            self.write_fake_executable('relion_helix_inimodel2d',
+                                       FAKE_INIMODEL.replace('{optimum}', str(optimum)))
+            star_file = self.write_class_averages()
+
+            with self.counter:
+                self.answers = ['bench', '1.0', star_file, 'n']
+                with self.stage('project creation'):
+                    Project(job='none')
+                project_folder = [f for f in os.listdir(self.workdir) if 'INI3DR' in f][0]
+                with self.stage('settings load'):
+                    project = Project(project_folder=project_folder, job='none')
+                project.settings['general_poll_interval'] = 0.05
+                project.settings['inimodel_pack_size'] = self.pack_size
+                self.answers = [str(co_min), str(co_max), '10']
+                with self.stage('inimodel settings'):
+                    project.initialize_inimodel()
+                with self.stage('folders and scripts'):
+                    project.create_inimodel_runs(project.get_crossover_range())
+                with self.stage('submission'):
+                    job_ids = project.inimodel_submit()
+                self.jobs = len(job_ids)
+                with self.stage('status polling'):
+                    project.wait_for_jobs(job_ids)
+                harvester = InimodelHarvester(project.inimodel_runs_master)
+                with self.stage('harvest (cold)'):
+                    ranking = harvester.harvest()
+                with self.stage('harvest (cached)'):
+                    harvester.harvest()
+                self.check_pipeline_selection(project, len(harvester.top()))
+            self.best = ranking[0]['co'] if len(ranking) > 0 else None
+            self.project_size = folder_size(os.path.join(self.workdir, project_folder))
+        finally:
+            builtins.input = old_input
+            os.environ['PATH'] = old_path
+            os.chdir(old_cwd)
+            if not self.keep:
+                shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def check_pipeline_selection(self, project, finished, top=3):
+        # Runs the selection job of a pipeline over the finished sweep, every slot up to top needs a crossover
+        refine_master = os.path.join(self.workdir, 'pipeline_selection')
+        os.mkdir(refine_master)
+        for slot in range(1, top + 1):
+            os.mkdir(os.path.join(refine_master, project.pipeline_slot_name(slot)))
+        particles = os.path.join(self.workdir, 'particles.star')
+        with open(particles, 'w') as fout:
+            fout.write('data_\n\nloop_\n_rlnImageName #1\n000001@particles.mrcs\n')
+        project.settings['refine_particles'] = particles
+        project.settings['refine_particle_diameter'] = 200
+        project.settings['refine_helical_outer_diameter'] = 100
+        project.settings['refine_pipeline_top'] = top
+        project.refine_runs_master = refine_master
+        project.write_refine_settings()
+        with self.stage('pipeline selection'):
+            project.pipeline_select(project.inimodel_runs_master, refine_master)
+        self.filled_slots = 0
+        for slot in range(1, top + 1):
+            with open(os.path.join(refine_master, project.pipeline_slot_name(slot), 'refine_command.sh')) as fin:
+                if 'relion_refine_mpi' in fin.read():
+                    self.filled_slots += 1
+        if self.filled_slots != min(top, finished):
+            raise RuntimeError('Pipeline selection filled ' + str(self.filled_slots) + ' of ' + str(top) +
+                               ' slots, ' + str(finished) + ' runs finished.')
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        with open(os.devnull, 'w') as devnull:
+            before = self.counter.snapshot()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(devnull):
+                yield
+            seconds = time.perf_counter() - start
+            after = self.counter.snapshot()
+        operations = dict()
+        for key in after:
+            if after[key] - before.get(key, 0) > 0:
+                operations[key] = after[key] - before.get(key, 0)
+        self.stages.append((name, seconds, operations))
+
+    def answer(self, prompt=''):
+        return self.answers.pop(0)
+
+    def setup_fake_cluster(self):
+        self.bin_dir = os.path.join(self.workdir, 'fake_bin')
+        state_dir = os.path.join(self.workdir, 'fake_slurm')
+        os.mkdir(self.bin_dir)
+        os.mkdir(state_dir)
+        os.mkdir(os.path.join(state_dir, 'done'))
+        self.write_fake_executable('sbatch', FAKE_SBATCH)
+        self.write_fake_executable('squeue', FAKE_SQUEUE)
+        self.write_fake_executable('sacct', FAKE_SACCT)
+        os.environ['FAKE_SLURM_DIR'] = state_dir
+        os.environ['PATH'] = self.bin_dir + os.pathsep + os.environ.get('PATH', '')
+
+    def write_fake_executable(self, name, template):
+        filename = os.path.join(self.bin_dir, name)
+        with open(filename, 'w') as fout:
+            fout.write(template.replace('{python}', sys.executable))
+        os.chmod(filename, 0o755)
+
+    def write_class_averages(self):
+        # Tiny class average stack (10 classes of 8x8 px) and its .star file
+        stack = os.path.join(self.workdir, 'class_averages.mrcs')
+        header = bytearray(1024)
+        struct.pack_into('<4i', header, 0, 8, 8, 10, 2)
+        header[208:212] = b'MAP '
+        header[212:216] = b'\x44\x44\x00\x00'
+        with open(stack, 'wb') as fout:
+            fout.write(bytes(header) + bytes(8 * 8 * 10 * 4))
+        star = os.path.join(self.workdir, 'class_averages.star')
+        with open(star, 'w') as fout:
+            fout.write('data_\n\nloop_\n_rlnImageName #1\n_rlnClassNumber #2\n')
+            for i in range(1, 11):
+                fout.write('{:06d}@Class2D/run_it025_classes.mrcs {}\n'.format(i, i))
+        return star
+
+    def report(self):
+        output = 'Sweep of ' + str(self.crossovers) + ' crossovers in ' + str(self.jobs) + \
+                 ' jobs (best crossover found: ' + str(self.best) + ', pipeline slots filled: ' + \
+                 str(self.filled_slots) + ')\n'
+        for name, seconds, operations in self.stages:
+            output += '  {:<20} {:>9.3f} s  {}'.format(
+                name, seconds, ' '.join([key + '=' + str(operations[key]) for key in sorted(operations)])) + '\n'
+        output += '  project folder: {} files, {} bytes'.format(*self.project_size) + '\n'
+        return output
+
+
+def folder_size(folder):
+    # (number of files, total bytes) of a folder, links are not followed
+    files = 0
+    size = 0
+    for root, dirs, filenames in os.walk(folder):
+        for filename in filenames:
+            files += 1
+            size += os.lstat(os.path.join(root, filename)).st_size
+    return files, size
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Dry-run benchmark of the InitialModelMaster orchestration.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000],
+                        help='Number of crossovers per sweep')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary working directories')
+    parser.add_argument('--pack-size', default=1, help='Crossovers per job (inimodel_pack_size)')
+    args = parser.parse_args()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    for size in args.sizes:
+        benchmark = Benchmark(size, keep=args.keep, pack_size=args.pack_size)
+        benchmark.run()
+        print(benchmark.report())
+        if args.keep:
+            print('  kept ' + benchmark.workdir)
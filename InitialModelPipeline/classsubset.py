@@ -0,0 +1,64 @@
+import re
+
+from mrc import MrcFile, write_mrc
+
+'''
+GOAL
+    - Select a subset of class averages without touching the rest of the stack
+    - Write a .star file that references only the chosen images of the original stack (no image data copied)
+    - Optionally write a compact stack of the chosen images (read slice by slice, written in one go)
+
+USAGE
+    - slices = parse_selection('1 4 7-9')
+    - subset_class_averages('ca.star', slices, 'subset.star')                                  # references ca.mrcs
+    - subset_class_averages('ca.star', slices, 'subset.star', 'ca.mrcs', 'subset.mrcs')        # compact stack
+'''
+
+# <slice>@<stack> as first token of a data row
+IMAGE_PATTERN = re.compile(r'^(\s*)(\d+)@(\S+)')
+
+
+def parse_selection(selection):
+    # '1 4 7-9' or '1,4,7-9' -> [1, 4, 7, 8, 9]
+    slices = []
+    for part in selection.replace(',', ' ').split():
+        if '-' in part:
+            first, last = part.split('-')
+            slices.extend(range(int(first), int(last) + 1))
+        else:
+            slices.append(int(part))
+    return slices
+
+
+def subset_class_averages(star, slices, out_star, stack=None, out_stack=None):
+    '''
+    Writes the rows of star whose image number is in slices to out_star, returns the number of rows written.
+    Without out_stack, the rows keep pointing to the original stack.
+    With out_stack, the chosen images of stack are written to out_stack and the rows point there.
+    '''
+    wanted = set(slices)
+    # Position of each chosen image in the compact stack
+    new_numbers = dict()
+    for number in sorted(wanted):
+        new_numbers[number] = len(new_numbers) + 1
+    rows = 0
+    with open(star) as fin, open(out_star, 'w') as fout:
+        for line in fin:
+            match = IMAGE_PATTERN.match(line)
+            if match is None:
+                fout.write(line)
+                continue
+            number = int(match.group(2))
+            if number not in wanted:
+                continue
+            if out_stack is not None:
+                image = '{}{:06d}@{}'.format(match.group(1), new_numbers[number], out_stack)
+                line = image + line[match.end():]
+            fout.write(line)
+            rows += 1
+    if out_stack is not None:
+        source = MrcFile(stack)
+        # Fancy indexing reads only the chosen slices of the mapping
+        indices = [number - 1 for number in sorted(wanted)]
+        write_mrc(out_stack, source.data[indices], voxel_size=source.voxel_size, is_stack=True)
+    return rows
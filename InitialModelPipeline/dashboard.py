@@ -0,0 +1,211 @@
+import argparse
+import json
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from inimodel_metrics import run_model_file
+from starpaths import AtomicWriter
+
+'''
+GOAL
+    - Status of all INI3DR projects of a working directory without opening them one by one
+    - Scan projects and their archives concurrently, ask the scheduler once for all job ids
+    - Keep a summary index on disk, so only projects, jobs and runs that changed are scanned again
+
+USAGE
+    - python3 dashboard.py [workdir]
+    - python3 InitialModelMaster.py status [workdir]
+    - rows = project_status(workdir)
+'''
+
+INDEX_NAME = '.ini3dr_status_index.json'
+# Written by relion_refine_mpi --auto_refine once a refinement has converged
+REFINE_RESULT = 'run_class001.mrc'
+
+
+def mtime(path):
+    # Modification time in ns, 0 if path does not exist
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def find_projects(workdir):
+    return sorted([entry.name for entry in os.scandir(workdir) if 'INI3DR' in entry.name and entry.is_dir()])
+
+
+def read_archive(projectdir):
+    # (jobtype, label, location) of the jobs in the archive of a project
+    jobs = []
+    archive = os.path.join(projectdir, 'project', 'archive.txt')
+    if not os.path.exists(archive):
+        return jobs
+    with open(archive) as fin:
+        for line in fin:
+            values = line.strip().split(',')
+            if len(values) == 6:
+                jobs.append((values[0], values[1], values[2]))
+    return jobs
+
+
+def read_job_ids(location):
+    # Scheduler ids recorded in job_ids.txt of a job folder
+    job_ids = []
+    filename = os.path.join(location, 'job_ids.txt')
+    if os.path.exists(filename):
+        with open(filename) as fin:
+            for line in fin:
+                values = line.strip().rsplit(',', 1)
+                if len(values) == 2:
+                    job_ids.append(values[1])
+    return job_ids
+
+
+def run_is_finished(jobtype, run_folder, name):
+    if jobtype == 'INIMODEL':
+        return os.path.exists(run_model_file(run_folder, name[:-2]))
+    return os.path.exists(os.path.join(run_folder, REFINE_RESULT))
+
+
+def is_run_folder(jobtype, name):
+    if jobtype == 'INIMODEL':
+        return name.endswith('co') and name[:-2].isdigit()
+    return name.endswith('_refine')
+
+
+def scan_job(jobtype, location, cached):
+    '''
+    Runs of a job folder {name: [mtime, finished]} and its job ids.
+    Finished runs are taken from the cached entry, unfinished runs are only checked again if their folder
+    changed, the run list only if the job folder changed.
+    '''
+    location_mtime = mtime(location)
+    ids_mtime = mtime(os.path.join(location, 'job_ids.txt'))
+    if cached is not None and cached['mtime'] == location_mtime:
+        runs = cached['runs']
+    else:
+        runs = dict()
+        if os.path.isdir(location):
+            for entry in os.scandir(location):
+                if is_run_folder(jobtype, entry.name) and entry.is_dir():
+                    runs[entry.name] = cached['runs'].get(entry.name, [0, False]) if cached is not None else [0, False]
+    for name in runs:
+        if runs[name][1]:
+            continue
+        run_folder = os.path.join(location, name)
+        run_mtime = mtime(run_folder)
+        if run_mtime != runs[name][0]:
+            runs[name] = [run_mtime, run_is_finished(jobtype, run_folder, name)]
+    if cached is not None and cached['ids_mtime'] == ids_mtime:
+        job_ids = cached['job_ids']
+    else:
+        job_ids = read_job_ids(location)
+    return dict(mtime=location_mtime, ids_mtime=ids_mtime, runs=runs, job_ids=job_ids)
+
+
+def scan_project(projectdir, cached):
+    # Jobs of a project {location: job entry}, the archive is only read again if it changed
+    archive_mtime = mtime(os.path.join(projectdir, 'project', 'archive.txt'))
+    if cached is not None and cached['archive_mtime'] == archive_mtime:
+        archive = cached['archive']
+    else:
+        archive = read_archive(projectdir)
+    cached_jobs = cached['jobs'] if cached is not None else dict()
+    jobs = dict()
+    for jobtype, label, location in archive:
+        jobs[location] = scan_job(jobtype, location, cached_jobs.get(location))
+    return dict(archive_mtime=archive_mtime, archive=archive, jobs=jobs)
+
+
+def scheduler_states(job_ids):
+    # {job id: state} of all queued jobs among job_ids, one squeue call
+    if len(job_ids) == 0:
+        return dict()
+    result = subprocess.run('squeue -h -o "%i %T" -j ' + ','.join(job_ids), shell=True, text=True,
+                            capture_output=True)
+    states = dict()
+    # squeue fails if it knows none of the ids anymore, then none is queued
+    for line in result.stdout.splitlines():
+        values = line.split()
+        if len(values) == 2:
+            states[values[0]] = values[1]
+    return states
+
+
+def load_index(path):
+    if not os.path.exists(path):
+        return dict()
+    try:
+        with open(path) as fin:
+            return json.load(fin)
+    except ValueError:
+        # Broken index, rebuilt from scratch
+        return dict()
+
+
+def project_status(workdir, workers=16):
+    '''
+    One row per archived job of all projects in workdir:
+    project, type, label, runs, finished, pending, running, state
+    state: running / pending (some jobs queued), finished (all runs have results), incomplete (nothing queued,
+    runs without results)
+    '''
+    index_path = os.path.join(workdir, INDEX_NAME)
+    index = load_index(index_path)
+    projects = find_projects(workdir)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        scans = list(pool.map(lambda project: scan_project(os.path.join(workdir, project), index.get(project)),
+                              projects))
+    index = dict(zip(projects, scans))
+    with AtomicWriter(index_path) as fout:
+        json.dump(index, fout)
+
+    # Only jobs with unfinished runs can still be queued
+    job_ids = []
+    for scan in scans:
+        for job in scan['jobs'].values():
+            if not all([run[1] for run in job['runs'].values()]):
+                job_ids.extend(job['job_ids'])
+    states = scheduler_states(job_ids)
+
+    rows = []
+    for project, scan in zip(projects, scans):
+        for jobtype, label, location in scan['archive']:
+            job = scan['jobs'][location]
+            finished = len([run for run in job['runs'].values() if run[1]])
+            job_states = [states[job_id] for job_id in job['job_ids'] if job_id in states]
+            running = job_states.count('RUNNING')
+            pending = len(job_states) - running
+            if running > 0:
+                state = 'running'
+            elif pending > 0:
+                state = 'pending'
+            elif finished == len(job['runs']) and finished > 0:
+                state = 'finished'
+            else:
+                state = 'incomplete'
+            rows.append(dict(project=project, type=jobtype, label=label, runs=len(job['runs']), finished=finished,
+                             pending=pending, running=running, state=state))
+    return rows
+
+
+def rows_to_string(rows):
+    tostring = '{:<32} {:<9} {:<40} {:>5} {:>8} {:>7} {:>7}  {}'.format(
+        'project', 'type', 'label', 'runs', 'finished', 'pending', 'running', 'state') + '\n'
+    for row in rows:
+        tostring += '{:<32} {:<9} {:<40} {:>5} {:>8} {:>7} {:>7}  {}'.format(
+            row['project'], row['type'], row['label'], row['runs'], row['finished'], row['pending'],
+            row['running'], row['state']) + '\n'
+    return tostring
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Status of all INI3DR projects of a working directory.')
+    parser.add_argument('workdir', nargs='?', default=os.getcwd())
+    args = parser.parse_args()
+    start = time.perf_counter()
+    print(rows_to_string(project_status(args.workdir)))
+    print('Scanned in {:.3f} s'.format(time.perf_counter() - start))
@@ -0,0 +1,183 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from inimodel_metrics import get_metric, run_model_file, run_output_file
+from mrc import MrcFile
+
+'''
+GOAL
+    - Scan all <co>co run folders of an inimodel job in parallel
+    - Extract status and quality metrics from the stdout log, stderr log and initial model MRC
+    - Keep a ranked table per job (ranking.txt in the job folder), only rescanning runs whose files changed
+
+USAGE
+    - harvester = InimodelHarvester(job_location)
+    - rows = harvester.harvest()   # ranked, best first
+    - best = harvester.top(3)      # ['900co', '950co', ...]
+    - finished = harvester.top()   # all finished runs, best first
+'''
+
+STATUS_FINISHED = 'FINISHED'
+STATUS_FAILED = 'FAILED'
+STATUS_RUNNING = 'RUNNING'
+STATUS_PENDING = 'PENDING'
+
+# Markers in the stderr file of a run that mean the run did not finish properly
+FAILURE_MARKERS = ('ERROR', 'CANCELLED', 'TIME LIMIT', 'Segmentation fault', 'Killed')
+
+CACHE_COLUMNS = ['co', 'status', 'score', 'rms', 'signature']
+
+
+class InimodelHarvester:
+    '''
+    Ranked result table of one inimodel job.
+    '''
+
+    def __init__(self, location, metric='log_score', workers=16):
+        self.location = location
+        self.metric_name = metric
+        self.metric = get_metric(metric)
+        self.workers = workers
+        self.cache_path = os.path.join(location, 'ranking.txt')
+        self.table = dict()
+
+    def harvest(self):
+        # Rescans changed runs, updates the cache and returns the ranked table
+        self.read_cache()
+        crossovers = self.find_runs()
+        signatures = dict()
+        to_scan = []
+        for co in crossovers:
+            signatures[co] = self.signature(co)
+            if co not in self.table or self.table[co]['signature'] != signatures[co]:
+                to_scan.append(co)
+        # Forget runs whose folders disappeared
+        for co in list(self.table):
+            if co not in signatures:
+                del self.table[co]
+        if len(to_scan) > 0:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for row in pool.map(self.scan_run, to_scan):
+                    row['signature'] = signatures[row['co']]
+                    self.table[row['co']] = row
+            self.write_cache()
+        return self.ranked()
+
+    def find_runs(self):
+        # Crossovers of all <co>co run folders
+        crossovers = []
+        for object in os.listdir(self.location):
+            if object.endswith('co') and object[:-2].isdigit() and \
+                    os.path.isdir(os.path.join(self.location, object)):
+                crossovers.append(int(object[:-2]))
+        return sorted(crossovers)
+
+    def run_folder(self, co):
+        return os.path.join(self.location, str(co) + 'co')
+
+    def signature(self, co):
+        # Cheap fingerprint of a run (size and modification time of its files)
+        fingerprint = []
+        try:
+            entries = sorted(os.scandir(self.run_folder(co)), key=lambda entry: entry.name)
+        except FileNotFoundError:
+            return ''
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                fingerprint.append(entry.name + ':' + str(stat.st_size) + ':' + str(stat.st_mtime_ns))
+        return hashlib.md5('|'.join(fingerprint).encode()).hexdigest()
+
+    def scan_run(self, co):
+        # Extracts status and quality metrics of a single run
+        directory = self.run_folder(co)
+        row = dict(co=co, status=STATUS_PENDING, score=None, rms=None, signature='')
+        model_file = run_model_file(directory, co)
+        output_file = run_output_file(directory, co)
+        error_file = os.path.join(directory, 'inimodel_' + str(co) + 'co.err')
+        if os.path.exists(model_file):
+            row['status'] = STATUS_FINISHED
+            row['score'] = self.metric(directory, co)
+            row['rms'] = self.read_rms(model_file)
+        elif os.path.exists(error_file) and self.has_failed(error_file):
+            row['status'] = STATUS_FAILED
+        elif os.path.exists(output_file):
+            row['status'] = STATUS_RUNNING
+        return row
+
+    def read_rms(self, model_file):
+        # RMS deviation from the mean density (MRC header), None for unreadable headers
+        try:
+            return MrcFile(model_file).rms
+        except (OSError, ValueError):
+            return None
+
+    def has_failed(self, error_file):
+        with open(error_file, errors='replace') as fin:
+            for line in fin:
+                for marker in FAILURE_MARKERS:
+                    if marker in line:
+                        return True
+        return False
+
+    def ranked(self):
+        # Finished runs with a score first (best first), then finished runs without score, then the rest
+        def sort_key(row):
+            if row['status'] == STATUS_FINISHED and row['score'] is not None:
+                return (0, -row['score'], row['co'])
+            if row['status'] == STATUS_FINISHED:
+                return (1, 0, row['co'])
+            return (2, 0, row['co'])
+
+        return sorted(self.table.values(), key=sort_key)
+
+    def top(self, n=None):
+        # Labels of the n best finished runs (all finished runs for n None), harvests first
+        rows = [row for row in self.harvest() if row['status'] == STATUS_FINISHED]
+        if n is not None:
+            rows = rows[:n]
+        return [str(row['co']) + 'co' for row in rows]
+
+    def table_to_string(self, rows=None):
+        if rows is None:
+            rows = self.ranked()
+        tostring = '{:>4} {:>8} {:>10} {:>16} {:>12}'.format('rank', 'co', 'status', self.metric_name, 'rms') + '\n'
+        for i in range(len(rows)):
+            row = rows[i]
+            tostring += '{:>4} {:>8} {:>10} {:>16} {:>12}'.format(
+                i + 1, str(row['co']) + 'co', row['status'], str(row['score']), str(row['rms'])) + '\n'
+        return tostring
+
+    def read_cache(self):
+        self.table = dict()
+        if not os.path.exists(self.cache_path):
+            return
+        with open(self.cache_path) as fin:
+            lines = fin.readlines()
+            # First line holds the metric the cache was built with
+            if len(lines) == 0 or lines[0].strip() != '# metric ' + self.metric_name:
+                return
+            for line in lines[1:]:
+                values = line.strip().split(',')
+                # Rows of older caches are rescanned
+                if len(values) != len(CACHE_COLUMNS):
+                    continue
+                co, status, score, rms, signature = values
+                self.table[int(co)] = dict(
+                    co=int(co),
+                    status=status,
+                    score=None if score == 'None' else float(score),
+                    rms=None if rms == 'None' else float(rms),
+                    signature=signature
+                )
+
+    def write_cache(self):
+        output = '# metric ' + self.metric_name + '\n'
+        for co in sorted(self.table):
+            output += ','.join([str(self.table[co][column]) for column in CACHE_COLUMNS]) + '\n'
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w') as fout:
+            fout.write(output)
+        os.replace(tmp_path, self.cache_path)
+
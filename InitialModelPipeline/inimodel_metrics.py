@@ -0,0 +1,58 @@
+import os
+import re
+
+'''
+GOAL
+    - Score finished relion_helix_inimodel2d runs, so crossover sweeps can be ranked automatically
+
+USAGE
+    - metric = get_metric('log_score')
+    - score = metric(run_folder, crossover)
+    - Every metric returns a float (higher is better) or None if the run has no usable result (yet)
+    - Add new metrics with register_metric(name, function)
+'''
+
+# Matches e.g. "score= -1.234e+05", "Score: 12.5", "log-likelihood 3.2"
+SCORE_PATTERN = re.compile(r'(?:score|likelihood)\S*\s*[=:]?\s*(-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)', re.IGNORECASE)
+
+
+def run_output_file(directory, crossover):
+    # Location of the stdout file written by the inimodel submission script
+    return os.path.join(directory, 'inimodel_' + str(crossover) + 'co.out')
+
+
+def run_model_file(directory, crossover):
+    # Location of the initial model written by relion_helix_inimodel2d
+    return os.path.join(directory, str(crossover) + 'co_initial_model.mrc')
+
+
+def log_score(directory, crossover):
+    # Last score / likelihood value reported in the run's stdout
+    # Only runs which wrote their initial model are scored
+    if not os.path.exists(run_model_file(directory, crossover)):
+        return None
+    output_file = run_output_file(directory, crossover)
+    if not os.path.exists(output_file):
+        return None
+    score = None
+    with open(output_file) as fin:
+        for line in fin:
+            match = SCORE_PATTERN.search(line)
+            if match:
+                score = float(match.group(1))
+    return score
+
+
+METRICS = dict(
+    log_score=log_score
+)
+
+
+def register_metric(name, function):
+    METRICS[name] = function
+
+
+def get_metric(name):
+    if name not in METRICS:
+        raise KeyError('Unknown inimodel metric ' + name + '. Available: ' + ', '.join(sorted(METRICS)))
+    return METRICS[name]
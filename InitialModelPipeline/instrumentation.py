@@ -0,0 +1,128 @@
+import argparse
+import contextlib
+import functools
+import json
+import os
+import subprocess
+import time
+
+'''
+GOAL
+    - Record how long the stages of InitialModelMaster take (JSON lines, one event per line)
+    - Record latency of scheduler calls (sbatch, squeue, sacct)
+    - Summarize the recorded events
+
+USAGE
+    - events = EventLog('project/timing.jsonl')
+    - with events.stage('manipulate_ca_starfile') as fields: ...; fields['lines'] = 10
+    - result = events.run('sbatch --parsable job.sh', capture_output=True)
+    - @timed() on methods of objects with an 'events' attribute
+    - python3 instrumentation.py project/timing.jsonl
+'''
+
+
+class EventLog:
+    '''
+    Appends events to a JSON lines file. Events before the file is known are kept and written once it is set.
+    '''
+
+    def __init__(self, path=None):
+        self.path = None
+        self.pending = []
+        if path is not None:
+            self.set_path(path)
+
+    def set_path(self, path):
+        self.path = path
+        pending, self.pending = self.pending, []
+        for event in pending:
+            self.write(event)
+
+    def emit(self, event, **fields):
+        record = dict(time=round(time.time(), 3), event=event)
+        record.update(fields)
+        if self.path is None:
+            self.pending.append(record)
+        else:
+            self.write(record)
+
+    def write(self, record):
+        with open(self.path, 'a') as fout:
+            fout.write(json.dumps(record) + '\n')
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        # Times the enclosed block, fields added to the yielded dict are stored with the event
+        start = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            self.emit('stage', stage=name, duration_s=round(time.perf_counter() - start, 6), **fields)
+
+    def run(self, cmd_string, **kwargs):
+        # subprocess.run(cmd_string, shell=True, ...) with its latency recorded
+        start = time.perf_counter()
+        returncode = None
+        try:
+            result = subprocess.run(cmd_string, shell=True, **kwargs)
+            returncode = result.returncode
+            return result
+        finally:
+            self.emit('subprocess', command=cmd_string.split()[0], duration_s=round(time.perf_counter() - start, 6),
+                      returncode=returncode)
+
+
+def timed(name=None):
+    # Decorator recording the duration of a method as stage event in self.events
+    # If the method returns a list, its length is stored as count
+    def decorator(method):
+        stage_name = name if name is not None else method.__name__
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            events = getattr(self, 'events', None)
+            if events is None:
+                return method(self, *args, **kwargs)
+            with events.stage(stage_name) as fields:
+                result = method(self, *args, **kwargs)
+                if isinstance(result, list):
+                    fields['count'] = len(result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def summarize(path):
+    # Count, total, mean and max duration per stage / subprocess command
+    totals = dict()
+    with open(path) as fin:
+        for line in fin:
+            line = line.strip()
+            if line == '':
+                continue
+            record = json.loads(line)
+            if 'duration_s' not in record:
+                continue
+            key = (record['event'], record.get('stage', record.get('command', '')))
+            entry = totals.setdefault(key, dict(count=0, total=0.0, max=0.0, items=0))
+            entry['count'] += 1
+            entry['total'] += record['duration_s']
+            entry['max'] = max(entry['max'], record['duration_s'])
+            entry['items'] += record.get('count', 0)
+    tostring = '{:<11} {:<32} {:>7} {:>11} {:>11} {:>11} {:>8}'.format(
+        'event', 'name', 'calls', 'total [s]', 'mean [s]', 'max [s]', 'items') + '\n'
+    for key in sorted(totals, key=lambda k: -totals[k]['total']):
+        entry = totals[key]
+        tostring += '{:<11} {:<32} {:>7} {:>11.4f} {:>11.4f} {:>11.4f} {:>8}'.format(
+            key[0], key[1], entry['count'], entry['total'], entry['total'] / entry['count'], entry['max'],
+            entry['items']) + '\n'
+    return tostring
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize InitialModelMaster timing events.')
+    parser.add_argument('path', nargs='?', default=os.path.join('project', 'timing.jsonl'))
+    args = parser.parse_args()
+    print(summarize(args.path))
@@ -0,0 +1,96 @@
+import hashlib
+import os
+
+'''
+GOAL
+    - Give every inimodel run a hash of its inputs (class average files, command parameters, software version)
+    - Remember where runs with a given hash were computed, across all projects of a working directory
+    - Reuse finished results instead of recomputing them
+
+USAGE
+    - digests = DigestCache(path)
+    - job_hash = inputs_hash([digests.digest(star), digests.digest(mrcs)], parameters, version)
+    - index = ResultIndex(path)
+    - earlier_run = index.lookup(job_hash, is_finished)
+    - index.add_many([(job_hash, run_folder), ...])
+'''
+
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+class DigestCache:
+    '''
+    SHA-256 digests of input files, cached by path, size and modification time.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.digests = dict()
+        if os.path.exists(path):
+            with open(path) as fin:
+                for line in fin:
+                    values = line.strip().rsplit(',', 3)
+                    if len(values) == 4:
+                        self.digests[(values[0], int(values[1]), int(values[2]))] = values[3]
+
+    def digest(self, filename):
+        filename = os.path.realpath(filename)
+        stat = os.stat(filename)
+        key = (filename, stat.st_size, stat.st_mtime_ns)
+        if key not in self.digests:
+            sha = hashlib.sha256()
+            with open(filename, 'rb') as fin:
+                while True:
+                    chunk = fin.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+            self.digests[key] = sha.hexdigest()
+            with open(self.path, 'a') as fout:
+                fout.write(','.join([filename, str(stat.st_size), str(stat.st_mtime_ns), self.digests[key]]) + '\n')
+        return self.digests[key]
+
+
+def inputs_hash(file_digests, parameters, version):
+    # Hash of file contents, parameters (dict) and software version
+    sha = hashlib.sha256()
+    for file_digest in file_digests:
+        sha.update(file_digest.encode())
+    for key in sorted(parameters):
+        sha.update(('{}={};'.format(key, parameters[key])).encode())
+    sha.update(version.encode())
+    return sha.hexdigest()
+
+
+class ResultIndex:
+    '''
+    Append-only index: input hash -> run folders computed with these inputs.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.index = dict()
+        if os.path.exists(path):
+            with open(path) as fin:
+                for line in fin:
+                    values = line.strip().split(',', 1)
+                    if len(values) == 2:
+                        self.index.setdefault(values[0], []).append(values[1])
+
+    def lookup(self, job_hash, is_finished):
+        # First run folder of this hash whose results are complete, None if there is none
+        for run_folder in self.index.get(job_hash, []):
+            if is_finished(run_folder):
+                return run_folder
+        return None
+
+    def add_many(self, entries):
+        # (job hash, run folder) pairs, appended in one write
+        if len(entries) == 0:
+            return
+        lines = ''
+        for job_hash, run_folder in entries:
+            self.index.setdefault(job_hash, []).append(run_folder)
+            lines += job_hash + ',' + run_folder + '\n'
+        with open(self.path, 'a') as fout:
+            fout.write(lines)
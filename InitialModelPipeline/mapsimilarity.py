@@ -0,0 +1,69 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from mrc import MrcFile
+
+'''
+GOAL
+    - Compare the initial models of a crossover sweep with each other (normalized cross-correlation)
+    - Pick distinct representatives in rank order, so nearly identical maps are not refined twice
+
+USAGE
+    - similarity = pairwise_similarity(files)                # n x n matrix, NaN for maps of other shapes
+    - chosen = select_distinct(files, 3, threshold=0.95)     # indices of up to 3 distinct maps, files best first
+'''
+
+# Maps are binned down to at most this box before comparing
+COMPARE_BOX = 64
+
+
+def load_normalized(filename, box=COMPARE_BOX):
+    # Binned map with zero mean and unit norm, flattened
+    volume = MrcFile(filename).data
+    factor = max(1, int(np.ceil(max(volume.shape) / float(box))))
+    if factor > 1:
+        # Crop to a multiple of the binning factor, then average factor^3 blocks
+        nz, ny, nx = [(n // factor) * factor for n in volume.shape]
+        volume = np.asarray(volume[:nz, :ny, :nx], dtype=np.float32)
+        volume = volume.reshape(nz // factor, factor, ny // factor, factor, nx // factor, factor).mean(axis=(1, 3, 5))
+    else:
+        volume = np.asarray(volume, dtype=np.float32)
+    vector = volume.ravel() - volume.mean()
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+
+def pairwise_similarity(files, workers=8, box=COMPARE_BOX):
+    # Normalized cross-correlation of all pairs of maps
+    # Maps are read in parallel, the correlations are one matrix product per group of maps of equal size
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        vectors = list(pool.map(lambda filename: load_normalized(filename, box), files))
+    similarity = np.full((len(files), len(files)), np.nan, dtype=np.float32)
+    groups = dict()
+    for i in range(len(vectors)):
+        groups.setdefault(vectors[i].size, []).append(i)
+    for indices in groups.values():
+        matrix = np.stack([vectors[i] for i in indices])
+        similarity[np.ix_(indices, indices)] = matrix @ matrix.T
+    return similarity
+
+
+def select_distinct(files, n, threshold=0.95, workers=8):
+    '''
+    Indices of up to n maps, taken greedily in the order of files (best first).
+    A map is skipped if it correlates at or above threshold with a map already taken,
+    so a slowly changing sweep does not collapse into a single representative.
+    '''
+    similarity = pairwise_similarity(files, workers=workers)
+    chosen = []
+    for i in range(len(files)):
+        if len(chosen) == n:
+            break
+        # NaN (maps of other shapes) never counts as similar
+        if any([similarity[i, j] >= threshold for j in chosen]):
+            continue
+        chosen.append(i)
+    return chosen
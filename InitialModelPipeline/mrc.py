@@ -0,0 +1,114 @@
+import struct
+
+import numpy as np
+
+'''
+GOAL
+    - Read MRC / MRCS headers without touching the voxels
+    - Map the voxels lazily with numpy.memmap, only the parts that are used get read
+
+USAGE
+    - mrc = MrcFile('900co_initial_model.mrc')
+    - mrc.shape, mrc.voxel_size      # header only
+    - volume = mrc.data              # numpy.memmap, shape (nz, ny, nx)
+    - image = MrcFile('class_averages.mrcs').slice(3)   # third image of a stack, read on demand
+    - write_mrc('out.mrcs', images, voxel_size=1.2)
+'''
+
+HEADER_SIZE = 1024
+
+# MRC modes -> numpy data types
+MODES = {
+    0: np.int8,
+    1: np.int16,
+    2: np.float32,
+    6: np.uint16,
+    12: np.float16
+}
+
+
+class MrcFile:
+    '''
+    Memory-mapped MRC file.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._data = None
+        with open(filename, 'rb') as fin:
+            self.header = fin.read(HEADER_SIZE)
+        if len(self.header) < HEADER_SIZE:
+            raise ValueError(filename + ' is too short for an MRC file.')
+        # Byte order from the machine stamp, 0x44 = little endian, 0x11 = big endian
+        self.endian = '<' if self.header[212] == 0x44 else '>'
+        if self.header[212] not in (0x44, 0x11):
+            # Old files without machine stamp: guess from a plausible mode
+            self.endian = '<' if struct.unpack('<i', self.header[12:16])[0] in MODES else '>'
+        self.nx, self.ny, self.nz, self.mode = struct.unpack(self.endian + '4i', self.header[0:16])
+        if self.mode not in MODES:
+            raise ValueError('Unsupported MRC mode ' + str(self.mode) + ' in ' + filename)
+        self.mx, self.my, self.mz = struct.unpack(self.endian + '3i', self.header[28:40])
+        self.cella = struct.unpack(self.endian + '3f', self.header[40:52])
+        self.dmin, self.dmax, self.dmean = struct.unpack(self.endian + '3f', self.header[76:88])
+        self.nsymbt = struct.unpack(self.endian + 'i', self.header[92:96])[0]
+        self.rms = struct.unpack(self.endian + 'f', self.header[216:220])[0]
+        self.dtype = np.dtype(MODES[self.mode]).newbyteorder(self.endian)
+        self.data_offset = HEADER_SIZE + self.nsymbt
+
+    @property
+    def shape(self):
+        return (self.nz, self.ny, self.nx)
+
+    @property
+    def voxel_size(self):
+        # Angstrom per voxel along x (0 if the header has no cell)
+        if self.mx == 0:
+            return 0.0
+        return self.cella[0] / self.mx
+
+    @property
+    def data(self):
+        # Voxels, mapped on first access
+        if self._data is None:
+            self._data = np.memmap(self.filename, dtype=self.dtype, mode='r', offset=self.data_offset,
+                                   shape=self.shape)
+        return self._data
+
+    def __len__(self):
+        # Number of images of a stack (sections of a volume)
+        return self.nz
+
+    def slice(self, number):
+        # Image <number> of a stack (1-based, as in <number>@stack.mrcs), a view into the mapping
+        if number < 1 or number > self.nz:
+            raise IndexError('Stack ' + self.filename + ' has no image ' + str(number))
+        return self.data[number - 1]
+
+    def close(self):
+        # Releases the mapping
+        self._data = None
+
+
+def write_mrc(filename, data, voxel_size=0.0, is_stack=False):
+    # Writes a float32 volume or stack (nz, ny, nx) with a fresh header, the voxels in one write
+    data = np.asarray(data, dtype=np.float32)
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    nz, ny, nx = data.shape
+    header = bytearray(HEADER_SIZE)
+    struct.pack_into('<4i', header, 0, nx, ny, nz, 2)
+    # Stacks have one section per image
+    struct.pack_into('<3i', header, 28, nx, ny, 1 if is_stack else nz)
+    struct.pack_into('<3f', header, 40, nx * voxel_size, ny * voxel_size, (1 if is_stack else nz) * voxel_size)
+    struct.pack_into('<3f', header, 52, 90.0, 90.0, 90.0)
+    struct.pack_into('<3i', header, 64, 1, 2, 3)
+    if data.size > 0:
+        struct.pack_into('<3f', header, 76, float(data.min()), float(data.max()), float(data.mean()))
+        struct.pack_into('<f', header, 216, float(data.std()))
+    # MRC2014 version number
+    struct.pack_into('<i', header, 108, 20140)
+    header[208:212] = b'MAP '
+    header[212:216] = b'\x44\x44\x00\x00'
+    with open(filename, 'wb') as fout:
+        fout.write(bytes(header))
+        data.astype('<f4', copy=False).tofile(fout)
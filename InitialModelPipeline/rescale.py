@@ -0,0 +1,94 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from mrc import MrcFile, write_mrc
+
+'''
+GOAL
+    - Bring initial models to the pixel size and box of the particles before refinement
+    - Change the pixel size by cropping / padding the Fourier transform, change the box by cropping / padding
+      in real space (centered)
+    - Rescale several maps in parallel
+
+USAGE
+    - volume = rescale_volume(volume, 1.1, 3.3, 256)                        # px 1.1 -> 3.3 A, box 256
+    - rescale_map('900co_initial_model.mrc', '900co_bin3.mrc', 3.3, 256)    # input px from the header
+    - rescale_maps([(in_file, out_file, 3.3, 256), ...], workers=4)
+'''
+
+
+def fourier_resample(volume, shape):
+    # Resamples volume to shape by cropping (downsampling) or zero padding (upsampling) its spectrum
+    full_axes = tuple(range(volume.ndim - 1))
+    spectrum = np.fft.fftshift(np.fft.rfftn(volume), axes=full_axes)
+    half_shape = tuple(shape[:-1]) + (shape[-1] // 2 + 1,)
+    resampled = np.zeros(half_shape, dtype=spectrum.dtype)
+    source = []
+    target = []
+    for axis in full_axes:
+        # Zero frequency sits at n // 2 after fftshift
+        n = spectrum.shape[axis]
+        m = half_shape[axis]
+        keep = min(n, m)
+        source.append(slice(n // 2 - keep // 2, n // 2 - keep // 2 + keep))
+        target.append(slice(m // 2 - keep // 2, m // 2 - keep // 2 + keep))
+    # Last axis of the real transform holds non-negative frequencies only
+    keep = min(spectrum.shape[-1], half_shape[-1])
+    source.append(slice(0, keep))
+    target.append(slice(0, keep))
+    resampled[tuple(target)] = spectrum[tuple(source)]
+    resampled = np.fft.irfftn(np.fft.ifftshift(resampled, axes=full_axes), s=shape)
+    # Keep the density values, the inverse transform divides by the new number of voxels
+    resampled *= float(np.prod(shape)) / float(np.prod(volume.shape))
+    return resampled.astype(np.float32)
+
+
+def pad_or_crop(volume, box):
+    # Centered crop or zero padding of every axis to box
+    output = np.zeros((box,) * volume.ndim, dtype=np.float32)
+    source = []
+    target = []
+    for n in volume.shape:
+        keep = min(n, box)
+        source.append(slice(n // 2 - keep // 2, n // 2 - keep // 2 + keep))
+        target.append(slice(box // 2 - keep // 2, box // 2 - keep // 2 + keep))
+    output[tuple(target)] = volume[tuple(source)]
+    return output
+
+
+def rescale_volume(volume, px_size, target_px_size, box):
+    # Volume with pixel size px_size -> target_px_size and box (0 keeps the box after rescaling)
+    volume = np.asarray(volume, dtype=np.float32)
+    if abs(px_size - target_px_size) > 1e-6:
+        shape = tuple([max(1, int(round(n * px_size / target_px_size))) for n in volume.shape])
+        volume = fourier_resample(volume, shape)
+    if box > 0 and volume.shape != (box,) * volume.ndim:
+        volume = pad_or_crop(volume, box)
+    return volume
+
+
+def rescale_map(filename, out_filename, target_px_size, box, px_size=0.0):
+    # Rescales an MRC map, px_size 0 takes the input pixel size from the header
+    # Written under a temporary name first, so an interrupted run leaves no incomplete map
+    source = MrcFile(filename)
+    if px_size <= 0:
+        px_size = source.voxel_size
+    if px_size <= 0:
+        raise ValueError(filename + ' has no pixel size in its header.')
+    volume = rescale_volume(source.data, px_size, target_px_size, box)
+    write_mrc(out_filename + '.part', volume, voxel_size=target_px_size)
+    os.replace(out_filename + '.part', out_filename)
+    return out_filename
+
+
+def rescale_maps(jobs, workers=4):
+    # jobs: (filename, out_filename, target_px_size, box, px_size) tuples, rescaled in parallel processes
+    if len(jobs) == 0:
+        return []
+    if len(jobs) == 1 or workers < 2:
+        return [rescale_map(*job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+        futures = [pool.submit(rescale_map, *job) for job in jobs]
+        return [future.result() for future in futures]
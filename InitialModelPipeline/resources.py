@@ -0,0 +1,230 @@
+import math
+import os
+import subprocess
+
+'''
+GOAL
+    - Collect elapsed time, max RSS and CPU efficiency of finished jobs (sacct, or usage.txt as local stand-in)
+    - Keep a resource history per project (project/resource_history.txt)
+    - Suggest time, CPU and memory requests for new jobs from that history
+
+USAGE
+    - usage = query_usage({job_id: run_folder})   # {job_id: dict(elapsed_s=.., max_rss_mb=.., cpu_efficiency=..)}
+    - usage = query_usage(jobs, run=events.run)   # sacct latency recorded in the EventLog
+    - history = ResourceHistory(path)
+    - history.add(records)
+    - suggestion = history.suggest('inimodel', box=256, crossover=900, iterations=10, particles=50)
+'''
+
+HISTORY_COLUMNS = ['jobtype', 'label', 'job_id', 'box', 'crossover', 'iterations', 'particles', 'cpus',
+                   'elapsed_s', 'max_rss_mb', 'cpu_efficiency', 'state']
+
+# Safety margins on top of the observed usage
+TIME_MARGIN = 1.5
+MEMORY_MARGIN = 1.25
+MIN_TIME_S = 10 * 60
+# Below this CPU efficiency, fewer CPUs are requested
+TARGET_CPU_EFFICIENCY = 0.8
+# Number of most similar finished jobs a suggestion is based on
+NEIGHBOURS = 5
+
+
+def parse_duration(string):
+    # Converts slurm durations ([DD-]HH:MM:SS, MM:SS.mmm) into seconds
+    string = string.strip()
+    if string == '' or string in ('INVALID', 'UNLIMITED'):
+        return 0.0
+    days = 0
+    if '-' in string:
+        days, string = string.split('-')
+        days = int(days)
+    parts = [float(part) for part in string.split(':')]
+    while len(parts) < 3:
+        parts.insert(0, 0.0)
+    return days * 86400 + parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+
+def format_duration(seconds):
+    # Converts seconds into a slurm time request, rounded up to 5 minutes
+    minutes = int(math.ceil(seconds / 300.0)) * 5
+    days, minutes = divmod(minutes, 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+    if days > 0:
+        return '{}-{:02d}:{:02d}:00'.format(days, hours, minutes)
+    return '{:02d}:{:02d}:00'.format(hours, minutes)
+
+
+def parse_memory(string):
+    # Converts sacct memory values (e.g. 1234K, 5.5G) into MB
+    string = string.strip()
+    if string == '':
+        return 0.0
+    units = dict(K=1.0 / 1024, M=1.0, G=1024.0, T=1024.0 * 1024)
+    if string[-1] in units:
+        return float(string[:-1]) * units[string[-1]]
+    return float(string) / (1024 * 1024)
+
+
+def run_shell(cmd_string, **kwargs):
+    # Default runner of the queries, same call as EventLog.run without recording the latency
+    return subprocess.run(cmd_string, shell=True, **kwargs)
+
+
+def query_sacct(job_ids, run=run_shell):
+    # Batched sacct query. Returns None if sacct is not available.
+    cmd_string = 'sacct -n -P -j ' + ','.join(job_ids) + ' --format=JobID,Elapsed,MaxRSS,TotalCPU,AllocCPUS,State'
+    try:
+        result = run(cmd_string, text=True, capture_output=True)
+    except OSError:
+        return None
+    if result.returncode != 0:
+        return None
+    usage = dict()
+    for line in result.stdout.splitlines():
+        fields = line.strip().split('|')
+        if len(fields) < 6:
+            continue
+        step_id, elapsed, max_rss, total_cpu, alloc_cpus, state = fields[:6]
+        job_id = step_id.split('.')[0]
+        if job_id not in usage:
+            usage[job_id] = dict(elapsed_s=0.0, max_rss_mb=0.0, total_cpu_s=0.0, cpus=0, state='')
+        entry = usage[job_id]
+        # Job allocation line: elapsed time, CPU time, CPUs and state of the whole job
+        if step_id == job_id:
+            entry['elapsed_s'] = parse_duration(elapsed)
+            entry['total_cpu_s'] = parse_duration(total_cpu)
+            entry['cpus'] = int(alloc_cpus) if alloc_cpus.isdigit() else 0
+            entry['state'] = state.split()[0] if state != '' else ''
+        # Max RSS is only reported per step
+        entry['max_rss_mb'] = max(entry['max_rss_mb'], parse_memory(max_rss))
+    for entry in usage.values():
+        if entry['elapsed_s'] > 0 and entry['cpus'] > 0:
+            entry['cpu_efficiency'] = entry['total_cpu_s'] / (entry['elapsed_s'] * entry['cpus'])
+        else:
+            entry['cpu_efficiency'] = 0.0
+    return usage
+
+
+def read_usage_file(directory):
+    # Local stand-in for sacct: usage.txt in the run folder with 'key = value' lines
+    # (elapsed_s, max_rss_mb, cpu_efficiency, cpus, state)
+    filename = os.path.join(directory, 'usage.txt')
+    if not os.path.exists(filename):
+        return None
+    entry = dict(elapsed_s=0.0, max_rss_mb=0.0, cpu_efficiency=0.0, cpus=0, state='COMPLETED')
+    with open(filename) as fin:
+        for line in fin:
+            if '=' not in line:
+                continue
+            key, value = line.split('=')[0].strip(), line.split('=')[1].strip()
+            if key == 'state':
+                entry[key] = value
+            elif key == 'cpus':
+                entry[key] = int(value)
+            else:
+                entry[key] = float(value)
+    return entry
+
+
+def query_usage(jobs, run=run_shell):
+    # jobs: {job_id: run folder}. Uses sacct, falls back to usage.txt in the run folders.
+    # run: runs the sacct command, e.g. EventLog.run to record its latency
+    usage = query_sacct(list(jobs), run=run)
+    if usage is None:
+        usage = dict()
+        for job_id, directory in jobs.items():
+            entry = read_usage_file(directory)
+            if entry is not None:
+                usage[job_id] = entry
+    return usage
+
+
+def count_star_rows(filename):
+    # Number of data rows in a .star file, without parsing the rows
+    rows = 0
+    with open(filename) as fin:
+        for line in fin:
+            stripped = line.strip()
+            if stripped == '' or stripped[0] in ('_', '#') or stripped.startswith('data_') or stripped == 'loop_':
+                continue
+            rows += 1
+    return rows
+
+
+class ResourceHistory:
+    '''
+    Resource usage of finished jobs of a project.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.records = []
+        if os.path.exists(path):
+            self.read()
+
+    def read(self):
+        self.records = []
+        with open(self.path) as fin:
+            for line in fin:
+                values = line.strip().split(',')
+                if len(values) != len(HISTORY_COLUMNS):
+                    continue
+                record = dict(zip(HISTORY_COLUMNS, values))
+                for key in ['box', 'crossover', 'iterations', 'particles', 'cpus']:
+                    record[key] = int(record[key])
+                for key in ['elapsed_s', 'max_rss_mb', 'cpu_efficiency']:
+                    record[key] = float(record[key])
+                self.records.append(record)
+
+    def add(self, records):
+        # Appends records (dicts with HISTORY_COLUMNS keys)
+        with open(self.path, 'a') as fout:
+            for record in records:
+                fout.write(','.join([str(record[column]) for column in HISTORY_COLUMNS]) + '\n')
+                self.records.append(record)
+
+    def known_ids(self):
+        return set([record['job_id'] for record in self.records])
+
+    def suggest(self, jobtype, box, crossover, iterations, particles):
+        # Suggests dict(time, cpus, mem_mb) from the most similar completed jobs, None without history
+        candidates = [record for record in self.records
+                      if record['jobtype'] == jobtype and record['state'] == 'COMPLETED' and record['elapsed_s'] > 0]
+        if len(candidates) == 0:
+            return None
+
+        def distance(record):
+            # Relative difference of the job keys
+            total = 0.0
+            for key, value in [('box', box), ('crossover', crossover), ('iterations', iterations),
+                               ('particles', particles)]:
+                total += abs(record[key] - value) / float(max(record[key], value, 1))
+            return total
+
+        def factor(new, old):
+            # 0 means unknown (e.g. auto-refine iterations), then the key does not scale the time
+            if new <= 0 or old <= 0:
+                return 1.0
+            return new / float(old)
+
+        neighbours = sorted(candidates, key=distance)[:NEIGHBOURS]
+        elapsed = 0.0
+        observed = 0.0
+        memory = 0.0
+        cpu_time = 0.0
+        for record in neighbours:
+            # Run time scales roughly with iterations and particles
+            scale = factor(iterations, record['iterations']) * factor(particles, record['particles'])
+            elapsed = max(elapsed, record['elapsed_s'] * scale)
+            observed = max(observed, record['elapsed_s'])
+            memory = max(memory, record['max_rss_mb'])
+            cpu_time = max(cpu_time, record['cpus'] * record['cpu_efficiency'])
+        # Never suggest more CPUs than the similar jobs had
+        max_cpus = max([record['cpus'] for record in neighbours])
+        cpus = min(max_cpus, max(1, int(math.ceil(cpu_time / TARGET_CPU_EFFICIENCY))))
+        return dict(
+            # Never below the time the similar jobs actually took
+            time=format_duration(max(elapsed * TIME_MARGIN, observed, MIN_TIME_S)),
+            cpus=cpus,
+            mem_mb=int(math.ceil(memory * MEMORY_MARGIN)) if memory > 0 else None
+        )
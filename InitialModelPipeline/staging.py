@@ -0,0 +1,117 @@
+import argparse
+import fcntl
+import hashlib
+import os
+import sys
+
+from starpaths import redirect_image_paths
+
+'''
+GOAL
+    - Copy the class average stack and .star file to node-local scratch once per node
+    - Share the staged copy between concurrent tasks on the node (file locks), verify it by checksum
+    - Point the staged .star file to the staged stack
+
+USAGE
+    - In a job script:
+      STAGED_CA=$(python3 staging.py --scratch "$TMPDIR" --star ca.star --stack ca.mrcs \
+                  --star-checksum <sha256> --stack-checksum <sha256>)
+    - Prints the location of the staged .star file
+    - Locally: stage_class_averages(star, stack, scratch=<temp dir>, ...)
+'''
+
+CHUNK_SIZE = 16 * 1024 * 1024
+STAGE_FOLDER = 'ini3dr_stage'
+
+
+class ChecksumError(Exception):
+    pass
+
+
+def stage_file(src, stage_dir, checksum):
+    # Copies src into stage_dir unless a verified copy is there already, returns the staged location
+    dst = os.path.join(stage_dir, os.path.basename(src))
+    checksum_file = dst + '.sha256'
+    with open(dst + '.lock', 'w') as lock:
+        # Concurrent tasks wait here until the first one has copied the file
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(dst) and read_checksum(checksum_file) == checksum:
+            return dst
+        tmp_path = dst + '.part'
+        sha = hashlib.sha256()
+        with open(src, 'rb') as fin:
+            with open(tmp_path, 'wb') as fout:
+                while True:
+                    chunk = fin.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+                    fout.write(chunk)
+        if sha.hexdigest() != checksum:
+            os.unlink(tmp_path)
+            raise ChecksumError('Checksum of ' + src + ' does not match, not staging it.')
+        os.replace(tmp_path, dst)
+        with open(checksum_file, 'w') as fout:
+            fout.write(checksum + '\n')
+    return dst
+
+
+def stage_star(src, stage_dir, checksum, stack_location):
+    # Writes a copy of the .star file pointing to the staged stack, returns its location
+    # Every .star file gets its own folder, several .star files can refer to the same stack
+    star_dir = os.path.join(stage_dir, checksum[:16])
+    os.makedirs(star_dir, exist_ok=True)
+    dst = os.path.join(star_dir, os.path.basename(src))
+    checksum_file = dst + '.sha256'
+    with open(dst + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(dst) and read_checksum(checksum_file) == checksum:
+            return dst
+        if file_checksum(src) != checksum:
+            raise ChecksumError('Checksum of ' + src + ' does not match, not staging it.')
+        redirect_image_paths(src, dst, stack_location)
+        with open(checksum_file, 'w') as fout:
+            fout.write(checksum + '\n')
+    return dst
+
+
+def file_checksum(filename):
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as fin:
+        while True:
+            chunk = fin.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def read_checksum(filename):
+    if not os.path.exists(filename):
+        return ''
+    with open(filename) as fin:
+        return fin.read().strip()
+
+
+def stage_class_averages(star, stack, scratch, star_checksum, stack_checksum):
+    # Stages the stack into <scratch>/ini3dr_stage/<stack checksum>/ and the .star file into a subfolder named
+    # after its checksum, returns the staged .star file
+    stage_dir = os.path.join(scratch, STAGE_FOLDER, stack_checksum[:16])
+    os.makedirs(stage_dir, exist_ok=True)
+    staged_stack = stage_file(stack, stage_dir, stack_checksum)
+    return stage_star(star, stage_dir, star_checksum, staged_stack)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stage class averages to node-local scratch.')
+    parser.add_argument('--scratch', required=True)
+    parser.add_argument('--star', required=True)
+    parser.add_argument('--stack', required=True)
+    parser.add_argument('--star-checksum', required=True)
+    parser.add_argument('--stack-checksum', required=True)
+    args = parser.parse_args()
+    try:
+        print(stage_class_averages(args.star, args.stack, args.scratch, args.star_checksum, args.stack_checksum))
+    except (OSError, ChecksumError) as error:
+        print('Staging failed: ' + str(error), file=sys.stderr)
+        sys.exit(1)
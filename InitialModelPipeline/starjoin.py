@@ -0,0 +1,176 @@
+import argparse
+import hashlib
+
+from starparser import Star
+from starpaths import AtomicWriter
+
+'''
+GOAL
+    - Join, merge and diff particle tables (.star) on a key column, e.g. rlnImageName or rlnMicrographName
+    - Index the smaller table by 64-bit hashes of its keys, stream the larger table row by row
+    - Nothing is loaded into pandas, the optics block and loop header of the streamed table are kept
+
+USAGE
+    - join('particles.star', 'selection.star', 'rlnImageName', 'joined.star')                # inner join
+    - join('particles.star', 'refined.star', 'rlnImageName', 'joined.star', how='left')
+    - difference('particles.star', 'bad.star', 'rlnMicrographName', 'clean.star')
+    - update('particles.star', 'refined.star', 'rlnImageName', 'updated.star', ['rlnAnglePsi', 'rlnOriginXAngst'])
+    - python3 starjoin.py join particles.star selection.star joined.star --key rlnImageName --how left
+'''
+
+# Written for rows of a left join without partner
+MISSING = '<NA>'
+
+
+def key_hash(key):
+    # 64-bit hash of a key, stable across processes
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+
+
+class KeyIndex:
+    '''
+    Rows of the particle loop of a .star file by hashed key, only the given columns are stored.
+    For duplicate keys the last row wins.
+    '''
+
+    def __init__(self, filename, key, columns=None):
+        self.filename = filename
+        self.rows = dict()
+        with open(filename) as fin:
+            header, all_columns, line = Star(filename, parse=False).read_loop_header(fin)
+            key_index = all_columns.index(key)
+            if columns is None:
+                columns = [column for column in all_columns if column != key]
+            self.columns = columns
+            indices = [all_columns.index(column) for column in columns]
+            while line is not None:
+                values = line.split()
+                if len(values) > 0:
+                    if values[0].startswith('data_'):
+                        break
+                    self.rows[key_hash(values[key_index])] = tuple([values[i] for i in indices])
+                line = next(fin, None)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, key):
+        return key_hash(key) in self.rows
+
+    def get(self, key):
+        return self.rows.get(key_hash(key))
+
+
+def add_columns(header, columns, new_columns):
+    # Loop header with new_columns appended after the last column line
+    last = max([i for i in range(len(header)) if header[i].strip().startswith('_')])
+    lines = ['_{} #{}\n'.format(column, len(columns) + 1 + i) for i, column in enumerate(new_columns)]
+    return header[:last + 1] + lines + header[last + 1:]
+
+
+def stream(table, out, key, write_header, process_row):
+    '''
+    Streams the particle loop of table into out.
+    write_header(header, columns) returns the header lines to write,
+    process_row(values, key_index) the values to write for a row, or None to drop it.
+    Returns (rows read, rows written).
+    '''
+    read = 0
+    written = 0
+    with open(table) as fin, AtomicWriter(out) as fout:
+        header, columns, line = Star(table, parse=False).read_loop_header(fin)
+        key_index = columns.index(key)
+        fout.writelines(write_header(header, columns))
+        while line is not None:
+            values = line.split()
+            if len(values) > 0:
+                if values[0].startswith('data_'):
+                    break
+                read += 1
+                values = process_row(values, key_index)
+                if values is not None:
+                    fout.write(' '.join(values) + '\n')
+                    written += 1
+            line = next(fin, None)
+    return read, written
+
+
+def join(table, other, key, out, how='inner', columns=None):
+    '''
+    Rows of table with the columns of other appended (the given columns, default all except the key;
+    columns table already has are skipped).
+    how='inner' drops rows without partner in other, 'left' keeps them with MISSING values.
+    '''
+    if how not in ('inner', 'left'):
+        raise ValueError('Unknown join ' + how + '. Available: inner, left')
+    index = KeyIndex(other, key, columns)
+    # Positions of the appended columns in the indexed rows
+    appended = []
+
+    def write_header(header, table_columns):
+        appended.extend([i for i in range(len(index.columns)) if index.columns[i] not in table_columns])
+        return add_columns(header, table_columns, [index.columns[i] for i in appended])
+
+    def process_row(values, key_index):
+        partner = index.get(values[key_index])
+        if partner is None:
+            return values + [MISSING] * len(appended) if how == 'left' else None
+        return values + [partner[i] for i in appended]
+
+    return stream(table, out, key, write_header, process_row)
+
+
+def difference(table, other, key, out):
+    # Rows of table whose key does not occur in other
+    index = KeyIndex(other, key, columns=[])
+
+    def process_row(values, key_index):
+        return None if values[key_index] in index else values
+
+    return stream(table, out, key, lambda header, table_columns: header, process_row)
+
+
+def update(table, other, key, out, columns=None):
+    '''
+    Rows of table with the given columns (default all of other except the key) taken from the row of other
+    with the same key. Columns table does not have are appended, rows without partner get MISSING there.
+    '''
+    index = KeyIndex(other, key, columns)
+    # Position of every indexed column in the output rows
+    targets = []
+    added = []
+
+    def write_header(header, table_columns):
+        added.extend([column for column in index.columns if column not in table_columns])
+        output_columns = table_columns + added
+        targets.extend([output_columns.index(column) for column in index.columns])
+        return add_columns(header, table_columns, added)
+
+    def process_row(values, key_index):
+        values = values + [MISSING] * len(added)
+        partner = index.get(values[key_index])
+        if partner is not None:
+            for i in range(len(targets)):
+                values[targets[i]] = partner[i]
+        return values
+
+    return stream(table, out, key, write_header, process_row)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Join, diff and update .star particle tables on a key column.')
+    parser.add_argument('operation', choices=['join', 'difference', 'update'])
+    parser.add_argument('table', help='Streamed (larger) table')
+    parser.add_argument('other', help='Indexed (smaller) table')
+    parser.add_argument('out')
+    parser.add_argument('--key', default='rlnImageName')
+    parser.add_argument('--how', default='inner', choices=['inner', 'left'])
+    parser.add_argument('--columns', nargs='+', default=None, help='Columns taken from the other table')
+    args = parser.parse_args()
+    if args.operation == 'join':
+        result = join(args.table, args.other, args.key, args.out, how=args.how, columns=args.columns)
+    elif args.operation == 'difference':
+        result = difference(args.table, args.other, args.key, args.out)
+    else:
+        result = update(args.table, args.other, args.key, args.out, columns=args.columns)
+    print('Read ' + str(result[0]) + ' rows, wrote ' + str(result[1]) + ' rows to ' + args.out)
@@ -1,4 +1,6 @@
 import os
+import random
+import zlib
 import pandas as pd
 
 '''
@@ -10,19 +12,42 @@ GOAL
 USAGE
     - get dataframe = parser.read(file)
     - safe into file = parser.write(dataframe, dictionary)
+    - split particles without parsing them = Star(file, parse=False).split(outdir, by='class')
+    - read only some columns / rows = Star(file, columns=['rlnImageName'], where={'rlnClassNumber': {2, 5}})
 '''
 
+# Modes of Star.split
+SPLIT_MODES = ['class', 'tube', 'random', 'stratified']
+# Columns of the particle loop each split mode needs
+SPLIT_COLUMNS = {
+    'class': ['rlnClassNumber'],
+    'tube': ['rlnMicrographName', 'rlnHelicalTubeID'],
+    'random': [],
+    'stratified': ['rlnClassNumber'],
+}
+
 
 class Star:
 
-    def __init__(self, filename=''):
+    def __init__(self, filename='', parse=True, columns=None, where=None):
+        '''
+        columns: names of the columns to keep (without ' #N'), None keeps all
+        where: {column: allowed values or function(value) -> bool}, rows failing a condition are dropped
+        Both apply to the loops containing the named columns, other loops are read completely.
+        '''
         self.lines = list()
         self.datablocks = list()
         self.datapairs = dict()
         self.filename = filename
         self.dataframes = list()
+        self.columns = columns
+        self.where = dict()
+        if where is not None:
+            for name, condition in where.items():
+                # Values are compared as read from the file
+                self.where[name] = condition if callable(condition) else set([str(value) for value in condition])
 
-        if filename != '':
+        if filename != '' and parse:
             self.read()
 
     def __str__(self):
@@ -64,21 +89,157 @@ class Star:
 
     def parse_datablocks(self):
         # Converts .star loop into a panda dataframe
+        # Only the columns / rows selected by self.columns and self.where are stored
         for datablock in self.datablocks:
             loop = dict()
             col_names = []
+            kept = None
             for line in datablock:
                 line = line.strip()
                 if line[0] == '_':
                     col_names.append(line[1:])
-                    loop[line[1:]] = []
-                else:
-                    values = line.split()
-                    for i in range(len(col_names)):
-                        loop[col_names[i]].append(values[i])
+                    continue
+                if kept is None:
+                    kept, conditions, maxsplit = self.select_columns(col_names)
+                    for i in kept:
+                        loop[col_names[i]] = []
+                # Fields after the last needed one are not split
+                values = line.split(None, maxsplit)
+                if not all([condition(values[i]) for i, condition in conditions]):
+                    continue
+                for i in kept:
+                    loop[col_names[i]].append(values[i])
+            if kept is None:
+                # Loop without rows
+                kept = self.select_columns(col_names)[0]
+                for i in kept:
+                    loop[col_names[i]] = []
             df = pd.DataFrame(loop)
             self.dataframes.append(df)
 
+    def select_columns(self, col_names):
+        # Indices of the kept columns, (index, condition) pairs and the number of splits a row needs
+        names = [col_name.split()[0] for col_name in col_names]
+        kept = list(range(len(names)))
+        if self.columns is not None and len(set(self.columns) & set(names)) > 0:
+            kept = [i for i in kept if names[i] in self.columns]
+        conditions = []
+        for i in range(len(names)):
+            if names[i] in self.where:
+                condition = self.where[names[i]]
+                if not callable(condition):
+                    condition = condition.__contains__
+                conditions.append((i, condition))
+        needed = kept + [i for i, condition in conditions]
+        maxsplit = max(needed) + 1 if len(needed) > 0 else 0
+        return kept, conditions, maxsplit
+
+    def read_loop_header(self, fin):
+        # Reads fin up to the first data row of the particle loop (first loop outside data_optics)
+        # Returns the lines before that row (optics block and loop header), the column names and the row
+        header = []
+        columns = []
+        block = ''
+        in_loop = False
+        for line in fin:
+            stripped = line.strip()
+            if stripped.startswith('data_'):
+                block = stripped
+                in_loop = False
+                columns = []
+            elif stripped == 'loop_':
+                in_loop = True
+                columns = []
+            elif in_loop and stripped.startswith('_'):
+                columns.append(stripped.split()[0][1:])
+            elif in_loop and stripped != '' and not stripped.startswith('#') and block != 'data_optics':
+                return header, columns, line
+            header.append(line)
+        return header, columns, None
+
+    def read_optics(self):
+        # Optics groups of self.filename as list of {column: value}, the particles are not read
+        with open(self.filename) as fin:
+            header = self.read_loop_header(fin)[0]
+        groups = []
+        columns = []
+        block = ''
+        for line in header:
+            stripped = line.strip()
+            if stripped.startswith('data_'):
+                block = stripped
+                columns = []
+            elif block != 'data_optics' or stripped in ('', 'loop_') or stripped.startswith('#'):
+                continue
+            elif stripped.startswith('_'):
+                columns.append(stripped.split()[0][1:])
+            else:
+                groups.append(dict(zip(columns, stripped.split())))
+        return groups
+
+    def split(self, outdir, by='class', n=2, seed=0):
+        '''
+        Splits the particles of self.filename into several .star files in one pass, without parsing them.
+        Every output keeps the optics block and the loop header.
+        - class: one file per rlnClassNumber
+        - tube: n files, all segments of a helical tube (rlnMicrographName, rlnHelicalTubeID) in the same file
+        - random: n files, every particle assigned at random
+        - stratified: n files, the particles of every class spread evenly over the files
+        Returns {subset key: filename}
+        '''
+        if by not in SPLIT_MODES:
+            raise ValueError('Unknown split mode ' + by + '. Available: ' + ', '.join(SPLIT_MODES))
+        stem = os.path.splitext(os.path.basename(self.filename))[0]
+        generator = random.Random(seed)
+        outputs = dict()
+        filenames = dict()
+        # Next subset per class for stratified splits, starting at a random subset
+        next_subset = dict()
+        with open(self.filename) as fin:
+            header, columns, line = self.read_loop_header(fin)
+            if line is None:
+                return filenames
+            missing = [column for column in SPLIT_COLUMNS[by] if column not in columns]
+            if len(missing) > 0:
+                raise ValueError(self.filename + ' has no ' + ', '.join(missing) + ' column, needed to split by ' + by)
+            if by in ('class', 'stratified'):
+                class_index = columns.index('rlnClassNumber')
+            if by == 'tube':
+                micrograph_index = columns.index('rlnMicrographName')
+                tube_index = columns.index('rlnHelicalTubeID')
+            try:
+                while line is not None:
+                    values = line.split()
+                    if len(values) == 0:
+                        line = next(fin, None)
+                        continue
+                    if values[0].startswith('data_'):
+                        # Further data blocks are not particles
+                        break
+                    if by == 'class':
+                        key = values[class_index]
+                    elif by == 'tube':
+                        tube = values[micrograph_index] + '@' + values[tube_index]
+                        key = str(zlib.crc32((str(seed) + tube).encode()) % n + 1)
+                    elif by == 'random':
+                        key = str(generator.randrange(n) + 1)
+                    else:
+                        class_number = values[class_index]
+                        if class_number not in next_subset:
+                            next_subset[class_number] = generator.randrange(n)
+                        key = str(next_subset[class_number] + 1)
+                        next_subset[class_number] = (next_subset[class_number] + 1) % n
+                    if key not in outputs:
+                        filenames[key] = os.path.join(outdir, stem + '_' + by + key + '.star')
+                        outputs[key] = open(filenames[key], 'w')
+                        outputs[key].writelines(header)
+                    outputs[key].write(line)
+                    line = next(fin, None)
+            finally:
+                for fout in outputs.values():
+                    fout.close()
+        return filenames
+
     def datapair_to_string(self):
         # Converts datapairs into a .star file compatible string
         sorted_dict = {key: value for key, value in sorted(self.datapairs.items())}
@@ -0,0 +1,71 @@
+import os
+import re
+import shutil
+import tempfile
+
+'''
+GOAL
+    - Redirect the image paths (<slice>@<stack>) of a .star file to another stack location
+    - Stream line by line (linear cost, constant memory) and replace the output file atomically
+
+USAGE
+    - redirect_image_paths('class_averages.star', 'class_averages.star', '/abs/path/class_averages.mrcs')
+    - redirect_image_paths('class_averages.star', 'project/2dclasses/class_averages.star', '/abs/path/ca.mrcs')
+'''
+
+# First token of a data row: <slice>@<stack path>
+IMAGE_PATH_PATTERN = re.compile(r'^(\s*\d+@)\S+')
+
+
+def redirect_image_paths(src, dst, stack_location):
+    # Writes src to dst with every image path pointing to stack_location, returns the number of rewritten lines
+    # src and dst may be the same file, dst is only replaced once it was written completely
+    replacement = lambda match: match.group(1) + stack_location
+    rewritten = 0
+    with open(src) as fin:
+        with AtomicWriter(dst) as fout:
+            for line in fin:
+                if '@' in line:
+                    line, count = IMAGE_PATH_PATTERN.subn(replacement, line, count=1)
+                    rewritten += count
+                fout.write(line)
+    return rewritten
+
+
+class AtomicWriter:
+    '''
+    File object writing into a temporary file next to the target, renamed onto the target on success.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fout = None
+        self.tmp_path = None
+
+    def __enter__(self):
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        fd, self.tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(self.filename) + '.')
+        self.fout = os.fdopen(fd, 'w')
+        return self.fout
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.fout.close()
+            os.unlink(self.tmp_path)
+            return False
+        self.fout.flush()
+        os.fsync(self.fout.fileno())
+        self.fout.close()
+        # Keep permissions of the file that gets replaced
+        if os.path.exists(self.filename):
+            shutil.copymode(self.filename, self.tmp_path)
+        else:
+            os.chmod(self.tmp_path, 0o666 & ~current_umask())
+        os.replace(self.tmp_path, self.filename)
+        return False
+
+
+def current_umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
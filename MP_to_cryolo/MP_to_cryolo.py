@@ -26,6 +26,8 @@ class Star:
         self.datapairs = dict()
         self.filename = filename
         self.dataframes = list()
+        # Only the filament coordinates are needed, other columns are not stored
+        self.columns = ['rlnCoordinateX', 'rlnCoordinateY']
         # Read .star file
         if filename != '':
             self.read()
@@ -78,18 +80,22 @@ class Star:
             self.datablocks.append(datablock)
 
     def parse_datablocks(self):
-        # Converts .star loop into a panda dataframe
+        # Converts .star loop into a panda dataframe, keeping only the columns in self.columns
         for datablock in self.datablocks:
             loop = dict()
             col_names = []
+            kept = []
             for line in datablock:
                 line = line.strip()
                 if line[0] == '_':
                     col_names.append(line[1:])
-                    loop[line[1:]] = []
+                    if line[1:].split()[0] in self.columns:
+                        kept.append(len(col_names) - 1)
+                        loop[line[1:]] = []
                 else:
-                    values = line.split()
-                    for i in range(len(col_names)):
+                    # Fields after the last kept one are not split
+                    values = line.split(None, max(kept) + 1 if len(kept) > 0 else 0)
+                    for i in kept:
                         loop[col_names[i]].append(values[i])
             df = pd.DataFrame(loop)
             self.dataframes.append(df)
@@ -180,10 +186,10 @@ class Star:
             cryolo_dict[col_name] = []
         fil_counter = 0
         for i in range(0, relion_df.shape[0] - 1, 2):
-            x1 = float(relion_df.iloc[i][0])
-            x2 = float(relion_df.iloc[i + 1][0])
-            y1 = float(relion_df.iloc[i][1])
-            y2 = float(relion_df.iloc[i + 1][1])
+            x1 = float(relion_df.iloc[i, 0])
+            x2 = float(relion_df.iloc[i + 1, 0])
+            y1 = float(relion_df.iloc[i, 1])
+            y2 = float(relion_df.iloc[i + 1, 1])
             # Distance set to 20 px
             coords = self.calculate_coordinates(x1, y1, x2, y2, distance=self.distance)
             for coordinate in coords: